@@ -17,6 +17,7 @@ if __name__ == '__main__':
 
     import glob
     pylab.figure()
+    obstructions = []
     for filename in glob.glob('/Users/nickp/Desktop/Dropbox/ortho/*.jpg'):
 
         img = cv2.imread(filename)
@@ -54,11 +55,13 @@ if __name__ == '__main__':
                 
             )
 
-            print(obstruction)
-
-            scene.create_area_annotation_latlngs(obstruction)
+            obstructions.append(obstruction)
             # break
 
+    result = scene.create_annotations(obstructions, annotation_type="AREA")
+    for index, error in result.failures:
+        print("failed", obstructions[index], error)
+
     pylab.xticks([])
     pylab.yticks([])
     pylab.axis('equal')
@@ -0,0 +1,87 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .config import config
+from .http_util import client
+
+ANNOTATION_STYLES = {
+    "AREA": {
+        "color": "#00ff00",
+        "fill_color": "#00ff00",
+        "description": "AI Created Area",
+        "type": "markergroup",
+    },
+    "COUNT": {
+        "color": "#f39c12",
+        "fill_color": "#e67e22",
+        "description": "AI Count",
+        "type": "polygon",
+    },
+}
+
+def annotation_payload(plan_id: str, annotation_type: str, geometry: List[Dict[str, float]]) -> Dict:
+    style = ANNOTATION_STYLES[annotation_type]
+    return {
+        "annotation_type": annotation_type,
+        "color": style["color"],
+        "color_locked": False,
+        "comments": [],
+        "content": [],
+        "deleted": False,
+        "description": style["description"],
+        "fill_color": style["fill_color"],
+        "geometry": geometry,
+        "plan_id": f"{plan_id}",
+        "type": style["type"],
+        "measurements_3d": []
+    }
+
+@dataclass
+class AnnotationResult:
+    # one per submitted geometry, None where creation failed, like Issue.create_bulk
+    ids: List[Optional[str]] = field(default_factory=list)
+    # (index into the submitted geometries, error message)
+    failures: List[Tuple[int, str]] = field(default_factory=list)
+
+    def __repr__(self):
+        return f'{len(self.ids) - len(self.failures)} annotations created, {len(self.failures)} failed'
+
+
+class AnnotationWriter(object):
+    # POSTs a batch of annotations over a thread pool, failures are collected not raised
+
+    def __init__(self, plan_id: str, headers: Dict[str, str], workers: int = None):
+        self.plan_id = plan_id
+        self.headers = headers
+        self.workers = workers or config.ANNOTATION_WORKERS
+
+    @property
+    def url(self):
+        return f'https://{config.PREFIX}.dronedeploy.com/api/v2/annotations/'
+
+    def post(self, body: str) -> Dict:
+        response = client.post(self.url, headers=self.headers, data=body)
+        response.raise_for_status()
+        return response.json()
+
+    def create(self, geometries: Iterable[List[Dict[str, float]]], annotation_type: str = "AREA") -> AnnotationResult:
+        bodies = [json.dumps(annotation_payload(self.plan_id, annotation_type, geometry)) for geometry in geometries]
+
+        def send(body):
+            try:
+                return self.post(body), None
+            except Exception as e:
+                return None, str(e)
+
+        result = AnnotationResult()
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as pool:
+            for index, (response, error) in enumerate(pool.map(send, bodies)):
+                if error is None and response.get('id') is None:
+                    error = response.get('message', 'no id in response')
+                if error is not None:
+                    result.failures.append((index, error))
+                result.ids.append(None if error is not None else response['id'])
+
+        return result
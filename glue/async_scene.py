@@ -0,0 +1,92 @@
+import asyncio, functools
+
+from .scene import Scene
+from .config import config
+
+class AsyncScene(object):
+    # runs the blocking Scene calls in the executor, bounded by a semaphore shared across plans
+
+    def __init__(self, scene: Scene, semaphore: asyncio.Semaphore = None):
+        self.scene = scene
+        self.semaphore = semaphore or asyncio.Semaphore(config.ASYNC_CONCURRENCY)
+        # one task per lazy asset, callers that arrive while it runs await the same one
+        self._assets = {}
+
+    @classmethod
+    async def open(cls, plan_id, base_cache_folder, semaphore=None):
+        # plan.json and cameras.json are fetched (or read from cache) here
+        semaphore = semaphore or asyncio.Semaphore(config.ASYNC_CONCURRENCY)
+        async with semaphore:
+            scene = await cls._executor(Scene, plan_id, base_cache_folder, lazy=True)
+        return cls(scene, semaphore)
+
+    def close(self):
+        self.scene.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    async def _executor(fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(fn, *args, **kwargs))
+
+    async def _run(self, fn, *args, **kwargs):
+        async with self.semaphore:
+            return await self._executor(fn, *args, **kwargs)
+
+    def _asset(self, name, fn):
+        task = self._assets.get(name)
+        # a failed load is tried again by the next caller
+        if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+            task = self._assets[name] = asyncio.ensure_future(self._run(fn))
+        return asyncio.shield(task)
+
+    @property
+    def plan(self):
+        return self.scene.plan
+
+    @property
+    def cameras(self):
+        return self.scene.cameras
+
+    @property
+    def transform(self):
+        return self.scene.transform
+
+    @property
+    def cache_folder(self):
+        return self.scene.cache_folder
+
+    async def download_image(self, image):
+        return await self._run(self.scene.download_image, image)
+
+    async def download_images(self):
+        images = [camera.image for camera in self.cameras]
+        images = [image for image in images if not self.scene.cached(image)]
+        return await asyncio.gather(*[self.download_image(image) for image in images])
+
+    async def download_export(self, export_filename, members=None):
+        return await self._run(self.scene.download_export, self.plan, export_filename, members)
+
+    async def download_pointcloud(self):
+        return await self._asset('pointcloud', lambda: self.scene.pointcloud)
+
+    async def download_mesh(self):
+        return await self._asset('mesh', lambda: self.scene.mesh)
+
+    async def create_area_annotation_latlngs(self, geometry):
+        return await self._run(self.scene.create_area_annotation_latlngs, geometry)
+
+    async def create_count_annotations_latlngs(self, geometry):
+        return await self._run(self.scene.create_count_annotations_latlngs, geometry)
+
+    async def create_count_annotations(self, camera, xys):
+        return await self._run(self.scene.create_count_annotations, camera, xys)
+
+    async def create_issue(self, camera, pixels):
+        issue = await self._asset('issue', lambda: self.scene.issue)
+        return await self._run(issue.create, camera, pixels)
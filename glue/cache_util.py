@@ -0,0 +1,239 @@
+import os, json, time, hashlib, threading
+from pathlib import Path
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from .config import config
+
+def part_path(local):
+    # unique per process and thread, so concurrent writers of one file never share a .part
+    return f'{local}.{os.getpid()}-{threading.get_ident()}.part'
+
+def write_atomic(local, content: bytes):
+    part = part_path(local)
+    with open(part, 'wb') as f:
+        f.write(content)
+    os.replace(part, local)
+
+def file_sha256(local, chunk_size=1 << 20) -> str:
+    sha = hashlib.sha256()
+    with open(local, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class CacheManifest(object):
+    # fetch time, size, validators and sha256 of every cached asset of a plan
+
+    FILENAME = 'manifest.json'
+
+    def __init__(self, cache_folder):
+        self.path = Path(cache_folder) / self.FILENAME
+        self.entries: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        if self.path.exists():
+            try:
+                self.entries = json.load(open(self.path))
+            except ValueError:
+                # a corrupt manifest only costs a revalidation of everything
+                self.entries = {}
+
+    def get(self, name) -> Optional[Dict]:
+        return self.entries.get(name)
+
+    def fresh(self, name, ttl=None) -> bool:
+        entry = self.get(name)
+        local = self.path.parent / name
+        if entry is None or not local.exists() or local.stat().st_size != entry.get('size'):
+            return False
+        if ttl is None:
+            return True
+        return time.time() - entry.get('fetched_at', 0) < ttl
+
+    def validators(self, name) -> Dict[str, str]:
+        entry = self.get(name) or {}
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def record(self, name, response=None) -> bool:
+        # True when the content changed
+        local = self.path.parent / name
+        sha256 = file_sha256(local)
+        with self._lock:
+            previous = self.entries.get(name, {})
+            self.entries[name] = {
+                'fetched_at': time.time(),
+                'size': local.stat().st_size,
+                'sha256': sha256,
+                'etag': response.headers.get('ETag') if response is not None else None,
+                'last_modified': response.headers.get('Last-Modified') if response is not None else None,
+            }
+            self.save()
+        return previous.get('sha256') != sha256
+
+    def touch(self, name):
+        with self._lock:
+            self.entries[name]['fetched_at'] = time.time()
+            self.save()
+
+    def save(self):
+        write_atomic(self.path, json.dumps(self.entries, indent=2).encode())
+
+
+# suffix -> asset class; anything else (json metadata, lock files) is never evicted
+ASSET_CLASSES = {
+    '.jpg': 'images',
+    '.jpeg': 'images',
+    '.png': 'images',
+    '.tif': 'images',
+    '.zip': 'exports',
+    '.las': 'extracted',
+    '.obj': 'extracted',
+    '.mtl': 'extracted',
+    '.npy': 'derived',
+    '.npz': 'derived',
+    '.part': 'partial',
+}
+
+def asset_class(path) -> Optional[str]:
+    return ASSET_CLASSES.get(Path(path).suffix.lower())
+
+@dataclass
+class CacheEntry:
+    path: Path
+    plan: str
+    asset_class: str
+    size: int
+    accessed: float
+
+
+class CacheManager(object):
+    # LRU eviction to byte budgets, plans held open by a live Scene are skipped
+
+    LOCK_PREFIX = '.open-'
+
+    # lock file -> scenes of this process holding the plan open, shared by every manager
+    _opened: Dict[Path, int] = {}
+    _opened_lock = threading.Lock()
+
+    def __init__(self, base_cache_folder, budget=None, plan_budget=None, class_budgets=None):
+        self.base_cache_folder = Path(base_cache_folder)
+        self.budget = budget if budget is not None else config.CACHE_BUDGET
+        self.plan_budget = plan_budget if plan_budget is not None else config.CACHE_PLAN_BUDGET
+        self.class_budgets = class_budgets if class_budgets is not None else (config.CACHE_CLASS_BUDGETS or {})
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def lock_file(self, plan_id):
+        return self.base_cache_folder / plan_id / f'{self.LOCK_PREFIX}{os.getpid()}'
+
+    def open(self, plan_id):
+        lock = self.lock_file(plan_id)
+        with self._opened_lock:
+            self._opened[lock] = self._opened.get(lock, 0) + 1
+            lock.touch()
+
+    def close(self, plan_id):
+        # the lock file goes with the last scene of this process to close the plan
+        lock = self.lock_file(plan_id)
+        with self._opened_lock:
+            count = self._opened.pop(lock, 0) - 1
+            if count > 0:
+                self._opened[lock] = count
+            elif lock.exists():
+                lock.unlink()
+
+    def is_open(self, plan_id) -> bool:
+        for lock in (self.base_cache_folder / plan_id).glob(f'{self.LOCK_PREFIX}*'):
+            pid = lock.name[len(self.LOCK_PREFIX):]
+            if not pid.isdigit():
+                continue
+            try:
+                os.kill(int(pid), 0)
+                return True
+            except ProcessLookupError:
+                # left behind by a process that died without closing its scene
+                lock.unlink()
+            except PermissionError:
+                return True
+        return False
+
+    def hit(self, local):
+        # reads alone do not reliably move atime, so bump it for the LRU order
+        stat = os.stat(local)
+        os.utime(local, (time.time(), stat.st_mtime))
+        with self._lock:
+            self.hits += 1
+
+    def miss(self, local):
+        with self._lock:
+            self.misses += 1
+
+    def entries(self) -> List[CacheEntry]:
+        ret = []
+        if not self.base_cache_folder.exists():
+            return ret
+        for plan in self.base_cache_folder.iterdir():
+            if not plan.is_dir():
+                continue
+            for path in plan.rglob('*'):
+                cls = asset_class(path)
+                if cls is None or not path.is_file():
+                    continue
+                stat = path.stat()
+                ret.append(CacheEntry(path, plan.name, cls, stat.st_size, max(stat.st_atime, stat.st_mtime)))
+        return ret
+
+    def usage(self) -> Dict[str, int]:
+        ret = {}
+        for entry in self.entries():
+            ret[entry.asset_class] = ret.get(entry.asset_class, 0) + entry.size
+        return ret
+
+    def evict(self) -> List[Path]:
+        if self.budget is None and self.plan_budget is None and not self.class_budgets:
+            return []
+
+        entries = self.entries()
+        opened = {plan for plan in {entry.plan for entry in entries} if self.is_open(plan)}
+        removed = []
+
+        def shrink(group, budget):
+            total = sum(entry.size for entry in group)
+            candidates = sorted((entry for entry in group if entry.plan not in opened), key=lambda entry: entry.accessed)
+            for entry in candidates:
+                if total <= budget:
+                    break
+                try:
+                    entry.path.unlink()
+                except FileNotFoundError:
+                    pass
+                total -= entry.size
+                removed.append(entry)
+
+        if self.plan_budget is not None:
+            for plan in {entry.plan for entry in entries}:
+                shrink([entry for entry in entries if entry.plan == plan], self.plan_budget)
+            entries = [entry for entry in entries if entry.path.exists()]
+
+        for cls, budget in self.class_budgets.items():
+            shrink([entry for entry in entries if entry.asset_class == cls], budget)
+        entries = [entry for entry in entries if entry.path.exists()]
+
+        if self.budget is not None:
+            shrink(entries, self.budget)
+
+        if removed:
+            print(f"evicted {len(removed)} files ({sum(entry.size for entry in removed) / 1e6:.1f} MB) from {self.base_cache_folder}")
+        return [entry.path for entry in removed]
+
+    def __repr__(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return f'cache {self.hits} hits, {self.misses} misses ({rate:.0%} hit rate)'
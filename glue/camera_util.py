@@ -1,5 +1,7 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Callable, Optional
 import numpy as np
+import os
 
 @dataclass
 class Sensor:
@@ -46,11 +48,15 @@ class Camera:
     image: str
     cache_folder: str
     index: None
+    # downloads the image on first access for scenes opened with lazy=True
+    fetch: Optional[Callable[[str], str]] = field(default=None, repr=False, compare=False)
 
     @property
     def filename(self):
         ret = self.cache_folder / self.image
         ret = str(ret)
+        if self.fetch is not None and not os.path.exists(ret):
+            self.fetch(self.image)
         return ret
     
     @property
@@ -96,6 +102,45 @@ class Camera:
     def distortion(self):
         return self.sensor.distortion
 
+    def undistort(self, xy, iterations=10):
+        # inverse of the distortion model by fixed point iteration
+        xy = np.atleast_2d(np.asarray(xy, dtype=np.float64))
+        K = self.K
+        xd = (xy[:, 0] - K[0, 2]) / K[0, 0]
+        yd = (xy[:, 1] - K[1, 2]) / K[1, 1]
+
+        k1, k2, k3, k4, p1, p2 = self.distortion
+        x, y = xd.copy(), yd.copy()
+        for _ in range(iterations):
+            x2 = x * x
+            y2 = y * y
+            r2 = x2 + y2
+            coeff = 1.0 + r2 * (k1 + r2 * (k2 + r2 * (k3 + r2 * k4)))
+            xy = x * y
+            x, y = (
+                (xd - p1 * xy * 2.0 - p2 * (r2 + x2 * 2.0)) / coeff,
+                (yd - p1 * (r2 + y2 * 2.0) - p2 * xy * 2.0) / coeff,
+            )
+        return np.vstack([x, y]).T
+
+    def border(self, margin=0, samples=9):
+        # pixels sampled along the image edges, grown by margin
+        xs = np.linspace(-margin, self.width + margin, samples)
+        ys = np.linspace(-margin, self.height + margin, samples)
+        return np.vstack([
+            np.vstack([xs, np.full(samples, ys[0])]).T,
+            np.vstack([xs, np.full(samples, ys[-1])]).T,
+            np.vstack([np.full(samples, xs[0]), ys]).T,
+            np.vstack([np.full(samples, xs[-1]), ys]).T,
+        ])
+
+    def rays(self, xy):
+        # unit ENU directions of the rays through the pixels xy
+        normalized = self.undistort(xy)
+        directions = np.hstack([normalized, np.ones((len(normalized), 1))])
+        directions = self.orientation.dot(directions.T).T
+        return directions / np.linalg.norm(directions, axis=1, keepdims=True)
+
     def display(self):
         import cv2
         img = cv2.imread(self.filename)
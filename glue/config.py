@@ -5,5 +5,49 @@ class Config:
     PREFIX = 'www'
     GQL_PREFIX = 'api'
     ISSUE_TYPE = 'IssueType:624'
+    DOWNLOAD_WORKERS = 8
+    DOWNLOAD_CHUNK_SIZE = 1 << 20
+    DOWNLOAD_ATTEMPTS = 3
+    EXTRACT_WORKERS = 4
+    HTTP_POOL_SIZE = 16
+    HTTP_RETRIES = 3
+    HTTP_BACKOFF = 0.5
+    HTTP_TIMEOUT = (10, 60)
+    ASYNC_CONCURRENCY = 16
+    ANNOTATION_WORKERS = 8
+    ISSUE_BATCH_SIZE = 50
+    ISSUE_WORKERS = 4
+    ISSUE_PAGE_SIZE = 100
+    # seconds before plan.json / cameras.json are revalidated, None trusts them forever
+    PLAN_TTL = 24 * 3600
+    CAMERAS_TTL = 24 * 3600
+    # byte budgets for base_cache_folder, None disables eviction
+    CACHE_BUDGET = None
+    CACHE_PLAN_BUDGET = None
+    CACHE_CLASS_BUDGETS = None
+    POINTCLOUD_CHUNK_SIZE = 2_000_000
+    # None uses every core
+    POINTCLOUD_WORKERS = None
+    INDEX_POINTS_PER_CELL = 64
+    # depth buffers are rendered at this fraction of the image resolution
+    DEPTH_SCALE = 0.25
+    DEPTH_FILL_RADIUS = 3
+    DEPTH_MEMO = 8
+    # points per projection chunk, sized so a chunk's scratch stays in cache
+    PROJECT_CHUNK_SIZE = 32768
+    # None uses every core
+    PROJECT_WORKERS = None
+    # fraction of the cameras seeing a point that must have it in their mask
+    VOTE_THRESHOLD = 0.8
+    VOTE_WORKERS = 4
+    RENDER_WORKERS = 4
+    # voxel pyramid level 0 averages about this many points per voxel
+    LOD_POINTS_PER_VOXEL = 4
+    # the pyramid stops at the first level with no more voxels than this
+    LOD_MIN_POINTS = 10000
+    # side in metres of the on-disk tiles
+    TILE_SIZE = 50.0
+    # also write the tiled format when converting a LAS
+    POINTCLOUD_TILED = False
 
 config = Config()
\ No newline at end of file
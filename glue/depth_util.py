@@ -0,0 +1,124 @@
+import numpy as np
+import os
+from pathlib import Path
+
+from .config import config
+from .cache_util import part_path
+
+def disk_offsets(radius):
+    # pixel offsets covered by a filled circle, the same footprint as cv2.circle
+    r = int(radius)
+    dy, dx = np.mgrid[-r:r + 1, -r:r + 1]
+    inside = dx * dx + dy * dy <= r * r
+    return dx[inside], dy[inside]
+
+def splat(pixels, z, colors, width, height, radius=3):
+    # nearest point per centre pixel first, then no two points of one disc offset pass collide
+    r = int(radius)
+    colors = np.asarray(colors)
+    # centres up to r pixels outside the image still reach into it, and discs
+    # around those reach another r further, so render on a canvas padded by 2r
+    pad = 2 * r
+    padded_width, padded_height = width + 2 * pad, height + 2 * pad
+
+    px = np.floor(np.asarray(pixels, dtype=np.float64) + 0.5).astype(np.int64) + pad
+    inside = (px[:, 0] >= r) & (px[:, 0] < padded_width - r) & (px[:, 1] >= r) & (px[:, 1] < padded_height - r)
+    px, z, colors = px[inside], np.asarray(z, dtype=np.float64)[inside], colors[inside]
+
+    pixel = px[:, 1] * padded_width + px[:, 0]
+    order = np.lexsort((z, pixel))
+    pixel = pixel[order]
+    first = np.ones(len(pixel), dtype=bool)
+    first[1:] = pixel[1:] != pixel[:-1]
+    order = order[first]
+    pixel, z = pixel[first], z[order]
+
+    depth = np.full(padded_height * padded_width, np.inf)
+    owner = np.full(padded_height * padded_width, -1, dtype=np.int64)
+    points = np.arange(len(pixel))
+    for dx, dy in zip(*disk_offsets(r)):
+        target = pixel + (dy * padded_width + dx)
+        near = z < depth[target]
+        target = target[near]
+        depth[target] = z[near]
+        owner[target] = points[near]
+
+    owner = owner.reshape((padded_height, padded_width))[pad:pad + height, pad:pad + width]
+    image = np.zeros((height, width) + colors.shape[1:], dtype=colors.dtype)
+    drawn = owner >= 0
+    image[drawn] = colors[order[owner[drawn]]]
+    return image
+
+
+class DepthBuffer(object):
+    # nearest point index per (downscaled) pixel of one camera
+
+    def __init__(self, depth, index, scale, num_points):
+        self.depth = depth
+        self.index = index
+        self.scale = float(scale)
+        self.num_points = int(num_points)
+
+    @classmethod
+    def render(cls, pointcloud, camera, scale=1.0):
+        W = max(int(camera.width * scale), 1)
+        H = max(int(camera.height * scale), 1)
+
+        projected, visible = pointcloud.project_visible(camera)
+        pose = np.asarray(camera.transform, dtype=np.float64)
+        z = pointcloud.xyz[visible].dot(pose[2, :3]) + pose[2, 3]
+
+        px = np.floor(projected * scale).astype(np.int64)
+        inside = (px[:, 0] >= 0) & (px[:, 0] < W) & (px[:, 1] >= 0) & (px[:, 1] < H)
+        visible, px, z = visible[inside], px[inside], z[inside]
+
+        # sort by pixel then depth, the first point of every pixel is the nearest
+        pixel = px[:, 1] * W + px[:, 0]
+        order = np.lexsort((z, pixel))
+        pixel = pixel[order]
+        first = np.ones(len(pixel), dtype=bool)
+        first[1:] = pixel[1:] != pixel[:-1]
+
+        depth = np.full(H * W, np.inf, dtype=np.float32)
+        index = np.full(H * W, -1, dtype=np.int32 if pointcloud.num_points < 2**31 else np.int64)
+        depth[pixel[first]] = z[order[first]]
+        index[pixel[first]] = visible[order[first]]
+        return cls(depth.reshape((H, W)), index.reshape((H, W)), scale, pointcloud.num_points)
+
+    @staticmethod
+    def filename(camera, scale):
+        return Path(camera.cache_folder) / 'depth' / f'{camera.image}.{scale:g}.npz'
+
+    def save(self, filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        part = part_path(filename)
+        with open(part, 'wb') as f:
+            np.savez(f, depth=self.depth, index=self.index, scale=self.scale, num_points=self.num_points)
+        os.replace(part, filename)
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        return cls(data['depth'], data['index'], data['scale'], data['num_points'])
+
+    def lookup(self, xys, radius=None):
+        # -1 where nothing was rendered within radius buffer pixels
+        radius = config.DEPTH_FILL_RADIUS if radius is None else radius
+        xys = np.atleast_2d(np.asarray(xys, dtype=np.float64))
+        H, W = self.index.shape
+
+        px = np.floor(xys * self.scale).astype(np.int64)
+        ret = np.full(len(px), -1, dtype=np.int64)
+        inside = (px[:, 0] >= 0) & (px[:, 0] < W) & (px[:, 1] >= 0) & (px[:, 1] < H)
+        ret[inside] = self.index[px[inside, 1], px[inside, 0]]
+
+        for row in np.where(inside & (ret < 0))[0]:
+            x, y = px[row]
+            x0, x1 = max(x - radius, 0), min(x + radius + 1, W)
+            y0, y1 = max(y - radius, 0), min(y + radius + 1, H)
+            window = self.index[y0:y1, x0:x1]
+            filled = np.argwhere(window >= 0)
+            if len(filled):
+                nearest = filled[np.argmin(np.sum((filled + [y0, x0] - [y, x]) ** 2, axis=1))]
+                ret[row] = window[nearest[0], nearest[1]]
+        return ret
@@ -0,0 +1,222 @@
+import os, time, base64, hashlib, shutil, zipfile, fcntl, requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, List, Optional
+
+from .config import config
+from .http_util import client
+from .cache_util import part_path
+
+@dataclass
+class DownloadStats:
+    total: int = 0
+    done: int = 0
+    skipped: int = 0
+    failed: int = 0
+    bytes: int = 0
+    started: float = field(default_factory=time.time)
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    @property
+    def rate(self):
+        # bytes per second over the wall clock time of the whole batch
+        return self.bytes / max(self.elapsed, 1e-6)
+
+    def __repr__(self):
+        rep = f'{self.done}/{self.total} downloaded, {self.skipped} cached, {self.failed} failed, '
+        rep += f'{self.bytes / 1e6:.1f} MB in {self.elapsed:.1f}s ({self.rate / 1e6:.2f} MB/s)'
+        return rep
+
+
+def download_concurrently(names: Iterable[str], download: Callable[[str], str], cached: Callable[[str], bool], workers: int = 8) -> DownloadStats:
+    names = list(names)
+    pending = [name for name in names if not cached(name)]
+
+    stats = DownloadStats(total=len(pending), skipped=len(names) - len(pending))
+    if not pending:
+        return stats
+
+    errors: List[Exception] = []
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(download, name): name for name in pending}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                local = future.result()
+                size = os.path.getsize(local) if local and os.path.exists(local) else 0
+            except Exception as e:
+                stats.failed += 1
+                errors.append(e)
+                print(f'failed {name}: {e}')
+                continue
+
+            stats.done += 1
+            stats.bytes += size
+            print(f'[{stats.done}/{stats.total}] {name} {size / 1e6:.1f} MB ({stats.rate / 1e6:.2f} MB/s)')
+
+    if errors:
+        raise errors[0]
+
+    return stats
+
+
+CONTENT_TYPES = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+}
+
+def expected_size(response) -> Optional[int]:
+    # Content-Length describes the encoded body, which is not what ends up on disk
+    if response.headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+    content_range = response.headers.get('Content-Range')
+    if response.status_code == 206 and content_range and '/' in content_range:
+        total = content_range.split('/')[-1]
+        return int(total) if total.isdigit() else None
+    length = response.headers.get('Content-Length')
+    return int(length) if length is not None and length.isdigit() else None
+
+def expected_md5(response) -> Optional[str]:
+    # GCS signed urls report the whole object hash even for ranged responses
+    for value in response.headers.get('x-goog-hash', '').split(','):
+        key, _, digest = value.strip().partition('=')
+        if key == 'md5':
+            return digest
+    # while Content-MD5 of a 206 covers the range only
+    return response.headers.get('Content-MD5') if response.status_code == 200 else None
+
+def downloaded(local: str, guess_ext: bool = False) -> Optional[str]:
+    if not guess_ext:
+        return local if os.path.exists(local) else None
+    return next((local + ext for ext in CONTENT_TYPES.values() if os.path.exists(local + ext)), None)
+
+def stream_to_file(url: str, local: str, ignore_404: bool = False, guess_ext: bool = False, chunk_size: int = None, attempts: int = None) -> str:
+    # the .part name stays stable so it can be resumed, an exclusive lock on
+    # {local}.lock keeps threads and processes sharing the cache off it
+    with open(f'{local}.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            # whoever held the lock before may have finished the download
+            done = downloaded(local, guess_ext)
+            if done is not None:
+                return done
+            done = resume(url, local, ignore_404, guess_ext, chunk_size, attempts)
+            if done:
+                # later writers find the file, so nobody is left waiting to write
+                os.remove(f'{local}.lock')
+            return done
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def resume(url: str, local: str, ignore_404: bool, guess_ext: bool, chunk_size: int = None, attempts: int = None) -> str:
+    # resumes a .part file with a Range request, renamed into place once size and md5 check out
+    chunk_size = chunk_size or config.DOWNLOAD_CHUNK_SIZE
+    attempts = attempts or config.DOWNLOAD_ATTEMPTS
+    part = f'{local}.part'
+
+    for attempt in range(attempts):
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+        try:
+            with client.get(url, headers=headers, stream=True) as r:
+                if r.status_code == 416:
+                    # the partial file is not a prefix of this object any more
+                    os.remove(part)
+                    continue
+                if ignore_404:
+                    assert r.status_code in (200, 206, 404)
+                else:
+                    assert r.status_code in (200, 206)
+                if r.status_code == 404:
+                    return ""
+                if r.status_code == 200:
+                    # the server ignored the range, start over
+                    offset = 0
+
+                if guess_ext:
+                    content_type = r.headers["Content-Type"]
+                    if content_type not in CONTENT_TYPES:
+                        raise ValueError("Unknown content-type: " + content_type)
+                    local_with_ext = local + CONTENT_TYPES[content_type]
+                else:
+                    local_with_ext = local
+
+                md5 = hashlib.md5()
+                if offset:
+                    print(f"resuming {os.path.basename(local)} at {offset / 1e6:.1f} MB")
+                    with open(part, 'rb') as f:
+                        for chunk in iter(lambda: f.read(chunk_size), b''):
+                            md5.update(chunk)
+
+                with open(part, 'ab' if offset else 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                        md5.update(chunk)
+
+                size = expected_size(r)
+                checksum = expected_md5(r)
+
+        except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            if attempt == attempts - 1:
+                raise
+            print(f"retrying {os.path.basename(local)}: {e}")
+            continue
+
+        actual = os.path.getsize(part)
+        if size is not None and actual != size:
+            if attempt == attempts - 1:
+                raise IOError(f"{local}: expected {size} bytes, got {actual}")
+            continue
+
+        if checksum is not None and base64.b64encode(md5.digest()).decode() != checksum:
+            os.remove(part)
+            raise IOError(f"{local}: md5 mismatch")
+
+        os.replace(part, local_with_ext)
+        return local_with_ext
+
+    raise IOError(f"{local}: download failed after {attempts} attempts")
+
+
+def extract_members(archive: str, folder: str, select: Callable[[str], bool] = None, workers: int = None) -> List[str]:
+    # members already on disk with the right size are skipped
+    workers = workers or config.EXTRACT_WORKERS
+
+    with zipfile.ZipFile(archive) as zf:
+        members = [info for info in zf.infolist() if not info.is_dir()]
+
+    if select is not None:
+        members = [info for info in members if select(info.filename)]
+
+    root = os.path.realpath(folder)
+    for info in members:
+        target = os.path.realpath(os.path.join(folder, info.filename))
+        if os.path.commonpath([root, target]) != root:
+            raise ValueError(f"{archive}: refusing to extract {info.filename} outside {folder}")
+
+    def extracted(info):
+        local = os.path.join(folder, info.filename)
+        return os.path.exists(local) and os.path.getsize(local) == info.file_size
+
+    def extract(info):
+        local = os.path.join(folder, info.filename)
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        # one handle per thread, ZipFile objects do not share well across threads
+        part = part_path(local)
+        with zipfile.ZipFile(archive) as zf, zf.open(info) as src, open(part, 'wb') as dst:
+            shutil.copyfileobj(src, dst, config.DOWNLOAD_CHUNK_SIZE)
+        os.replace(part, local)
+        return local
+
+    pending = [info for info in members if not extracted(info)]
+    if pending:
+        print("extracting", ", ".join(info.filename for info in pending), "from", os.path.basename(archive))
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(pending)))) as pool:
+            list(pool.map(extract, pending))
+
+    return [os.path.join(folder, info.filename) for info in members]
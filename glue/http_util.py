@@ -0,0 +1,89 @@
+import threading, time, requests
+from dataclasses import dataclass, field
+from typing import Dict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .config import config
+
+@dataclass
+class RequestStats:
+    count: int = 0
+    errors: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+    by_method: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def mean_time(self):
+        return self.total_time / self.count if self.count else 0.0
+
+    def __repr__(self):
+        rep = f'{self.count} requests ({self.errors} errors), '
+        rep += f'mean {self.mean_time * 1000:.0f} ms, max {self.max_time * 1000:.0f} ms'
+        return rep
+
+
+class HttpClient(object):
+    # status retries only for idempotent methods so a POST is never sent twice
+
+    def __init__(self, pool_size=None, retries=None, backoff=None, timeout=None):
+        self.stats = RequestStats()
+        self._lock = threading.Lock()
+        self.configure(pool_size, retries, backoff, timeout)
+
+    def configure(self, pool_size=None, retries=None, backoff=None, timeout=None):
+        # rebuilt in place, so every module holding `client` picks up the new settings;
+        # anything not given is read from config again
+        self.pool_size = pool_size or config.HTTP_POOL_SIZE
+        self.retries = config.HTTP_RETRIES if retries is None else retries
+        self.backoff = config.HTTP_BACKOFF if backoff is None else backoff
+        self.timeout = timeout or config.HTTP_TIMEOUT
+
+        retry = Retry(
+            total=self.retries,
+            backoff_factor=self.backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        # requests already running finish on the old session
+        self.session = session
+        return self
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.time()
+        failed = False
+        try:
+            return self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            failed = True
+            raise
+        finally:
+            elapsed = time.time() - start
+            with self._lock:
+                self.stats.count += 1
+                self.stats.errors += int(failed)
+                self.stats.total_time += elapsed
+                self.stats.max_time = max(self.stats.max_time, elapsed)
+                self.stats.by_method[method] = self.stats.by_method.get(method, 0) + 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+
+client = HttpClient()
+
+def configure(pool_size=None, retries=None, backoff=None, timeout=None) -> HttpClient:
+    return client.configure(pool_size, retries, backoff, timeout)
@@ -1,7 +1,10 @@
-import requests, json
-from typing import Dict, List
+import json
+import numpy as np
+from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
 
 from .config import config
+from .http_util import client
 from .conv_utils import enu2lla
 from .pointcloud_utils import PointCloud
 from .camera_util import Camera, Transform
@@ -35,84 +38,115 @@ class Issue:
                 }
             """
         }
-        response = requests.post(f'https://{config.GQL_PREFIX}.dronedeploy.com/graphql', headers=self.headers, data=json.dumps(query))
+        response = client.post(f'https://{config.GQL_PREFIX}.dronedeploy.com/graphql', headers=self.headers, data=json.dumps(query))
 
-    def list(self):
-        query = {
-        "operationName": "LoadPaginatedIssues",
-        "variables": {
-            "cursor": "",
-            "project": f"Project:{self.folder_id}"
-        },
-        "query": """query LoadPaginatedIssues($project: ID!, $cursor: String) {
-            project(id: $project) {
-                issues(first: 100, after: $cursor) {
-                    edges {
-                        node {
-                            ...IssueView
+    def list(self, page_size:int=None, initial_plan:str=None):
+        # the next page is fetched in the background; initial_plan is matched
+        # against the initialPlan the query already selects, not sent as a filter
+        page_size = page_size or config.ISSUE_PAGE_SIZE
+
+        def fetch(cursor):
+            query = {
+            "operationName": "LoadPaginatedIssues",
+            "variables": {
+                "cursor": cursor,
+                "first": page_size,
+                "project": f"Project:{self.folder_id}"
+            },
+            "query": """query LoadPaginatedIssues($project: ID!, $cursor: String, $first: Int) {
+                project(id: $project) {
+                    issues(first: $first, after: $cursor) {
+                        edges {
+                            node {
+                                ...IssueView
+                            }
+                        }
+                        pageInfo {
+                            hasNextPage
+                            endCursor
                         }
                     }
-        
                 }
             }
-        }
-        fragment IssueView on Issue {
-            id
-            createdIn
-            folder {
-                id
-            }
-            initialPlan {
+            fragment IssueView on Issue {
                 id
+                createdIn
+                folder {
+                    id
+                }
+                initialPlan {
+                    id
+                }
+                location {
+                    lng
+                    lat
+                    alt
+                }
             }
-            location {
-                lng
-                lat
-                alt
+            """
             }
+            response = client.post(f'https://{config.GQL_PREFIX}.dronedeploy.com/graphql', headers=self.headers, data=json.dumps(query))
+            response = response.json()
+            project = (response.get('data') or {}).get('project')
+            if project is None:
+                raise RuntimeError(f"listing issues failed: {response.get('errors')}")
+            return project['issues']
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            page = pool.submit(fetch, "")
+            while page is not None:
+                issues = page.result()
+                info = issues.get('pageInfo') or {}
+                if info.get('hasNextPage') and info.get('endCursor'):
+                    page = pool.submit(fetch, info['endCursor'])
+                else:
+                    page = None
+
+                for issue in issues['edges']:
+                    if initial_plan is not None and (issue['node'].get('initialPlan') or {}).get('id') != f"Plan:{initial_plan}":
+                        continue
+                    yield (issue['node']['id'])
+
+    def issue_input(self, camera: Camera, xy: Pixel, lla, _pixel_buffer:int=5) -> Dict:
+        vertices = [
+            dict(x=(xy[0] - _pixel_buffer) / camera.width, y=(xy[1] - _pixel_buffer) / camera.height),
+            dict(x=(xy[0] + _pixel_buffer) / camera.width, y=(xy[1] - _pixel_buffer) / camera.height),
+            dict(x=(xy[0] + _pixel_buffer) / camera.width, y=(xy[1] + _pixel_buffer) / camera.height),
+            dict(x=(xy[0] - _pixel_buffer) / camera.width, y=(xy[1] + _pixel_buffer) / camera.height),
+            dict(x=(xy[0] - _pixel_buffer) / camera.width, y=(xy[1] - _pixel_buffer) / camera.height),
+        ]
+
+        lng, lat, alt = lla
+
+        return {
+            "assetName": camera.image,
+            "createdIn": "3d",
+            "folderId": self.folder_id,
+            "location": {
+                "lat":lat,
+                "lng":lng,
+                "alt":alt
+            },
+            "mediaBoundingPolygon": {
+                # Bounding box in image [0 .. 1] x [0 .. 1]
+                "vertices":vertices
+            },
+            "planId":self.plan_id,
+            "summary":"",
+            "typeId":config.ISSUE_TYPE
         }
-        """
-        }
-        response = requests.post(f'https://{config.GQL_PREFIX}.dronedeploy.com/graphql', headers=self.headers, data=json.dumps(query))
-        response = response.json()
-        for issue in response['data']['project']['issues']['edges']:
-            yield (issue['node']['id'])
 
     def create(self, camera: Camera, pixels: List[Pixel], _pixel_buffer:int=5):
 
-        for xy in pixels:
-            enu = self.pointcloud.ray_cast(camera, xy)
-            lla = enu2lla(enu, self.transform.R, self.transform.S, self.transform.T)
-            vertices = [
-                dict(x=(xy[0] - _pixel_buffer) / camera.width, y=(xy[1] - _pixel_buffer) / camera.height),
-                dict(x=(xy[0] + _pixel_buffer) / camera.width, y=(xy[1] - _pixel_buffer) / camera.height),
-                dict(x=(xy[0] + _pixel_buffer) / camera.width, y=(xy[1] + _pixel_buffer) / camera.height),
-                dict(x=(xy[0] - _pixel_buffer) / camera.width, y=(xy[1] + _pixel_buffer) / camera.height),
-                dict(x=(xy[0] - _pixel_buffer) / camera.width, y=(xy[1] - _pixel_buffer) / camera.height),
-            ]
-            
-            lng, lat, alt = lla[0]
+        enu = self.pointcloud.ray_cast_many(camera, pixels)
+        llas = enu2lla(enu, self.transform.R, self.transform.S, self.transform.T)
+
+        for xy, lla in zip(pixels, llas):
 
             issue = {
                 "operationName":"CreateIssue",
                 "variables":{
-                    "input":{
-                        "assetName": camera.image,
-                        "createdIn": "3d",
-                        "folderId": self.folder_id,
-                        "location": {
-                            "lat":lat,
-                            "lng":lng,
-                            "alt":alt
-                        },
-                        "mediaBoundingPolygon": {
-                            # Bounding box in image [0 .. 1] x [0 .. 1]
-                            "vertices":vertices
-                        },
-                        "planId":self.plan_id,
-                        "summary":"",
-                        "typeId":config.ISSUE_TYPE
-                    }
+                    "input": self.issue_input(camera, xy, lla, _pixel_buffer)
                 },
 
                 "query": """
@@ -216,6 +250,54 @@ class Issue:
             }
 
 
-            response = requests.post(f'https://{config.GQL_PREFIX}.dronedeploy.com/graphql', headers=self.headers, data=json.dumps(issue))
+            response = client.post(f'https://{config.GQL_PREFIX}.dronedeploy.com/graphql', headers=self.headers, data=json.dumps(issue))
             response = response.json()
-            print(json.dumps(response, indent=2))
\ No newline at end of file
+            print(json.dumps(response, indent=2))
+
+    def create_bulk(self, camera: Camera, pixels: List[Pixel], _pixel_buffer:int=5, batch_size:int=None, workers:int=None) -> List[Optional[str]]:
+        # issue ids in pixel order, None where creation failed
+        batch_size = batch_size or config.ISSUE_BATCH_SIZE
+        workers = workers or config.ISSUE_WORKERS
+
+        enu = self.pointcloud.ray_cast_many(camera, pixels)
+        llas = np.asarray(enu2lla(enu, self.transform.R, self.transform.S, self.transform.T))
+        # pixels that see no points have no location, and a NaN would sink their whole batch
+        located = np.where(~np.isnan(llas).any(axis=1))[0]
+        inputs = [self.issue_input(camera, pixels[index], llas[index], _pixel_buffer) for index in located]
+
+        batches = [inputs[start:start + batch_size] for start in range(0, len(inputs), batch_size)]
+
+        def send(batch):
+            arguments = ", ".join(f"$input{index}: CreateIssueInput!" for index in range(len(batch)))
+            mutations = "\n".join(
+                f"issue{index}: createIssue(input: $input{index}) {{ issue {{ id }} }}"
+                for index in range(len(batch))
+            )
+            query = {
+                "operationName": "CreateIssues",
+                "variables": {f"input{index}": issue for index, issue in enumerate(batch)},
+                "query": f"mutation CreateIssues({arguments}) {{\n{mutations}\n}}",
+            }
+            try:
+                response = client.post(f'https://{config.GQL_PREFIX}.dronedeploy.com/graphql', headers=self.headers, data=json.dumps(query, allow_nan=False))
+                response = response.json()
+            except Exception as e:
+                print("issue batch failed:", e)
+                return [None] * len(batch)
+
+            for error in response.get('errors') or []:
+                print("issue error:", error.get('message'))
+
+            data = response.get('data') or {}
+            ids = []
+            for index in range(len(batch)):
+                created = data.get(f"issue{index}") or {}
+                ids.append((created.get('issue') or {}).get('id'))
+            return ids
+
+        ids = [None] * len(pixels)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            created = [issue_id for batch_ids in pool.map(send, batches) for issue_id in batch_ids]
+        for index, issue_id in zip(located, created):
+            ids[index] = issue_id
+        return ids
@@ -0,0 +1,128 @@
+import numpy as np
+import os
+
+from .config import config
+from .cache_util import part_path
+
+def voxel_keys(xyz, origin, size, dims):
+    keys = np.floor((xyz - origin) / size).astype(np.int64)
+    return (keys[:, 2] * dims[1] + keys[:, 1]) * dims[0] + keys[:, 0]
+
+def sum_voxels(keys, xyz, rgb, count):
+    # plain sums per key, the key order np.unique gives
+    voxels, inverse = np.unique(keys, return_inverse=True)
+    inverse = inverse.ravel()
+    total = lambda values: np.bincount(inverse, weights=values, minlength=len(voxels))
+    sums = lambda values: np.stack([total(values[:, i]) for i in range(values.shape[1])], axis=1)
+    return voxels, sums(xyz), sums(rgb), total(count)
+
+def merge_voxels(xyz, rgb, count, origin, size):
+    dims = np.floor((xyz - origin) / size).astype(np.int64).max(axis=0) + 1
+    weights = count[:, None]
+    _, xyz, rgb, total = sum_voxels(voxel_keys(xyz, origin, size, dims), xyz * weights, rgb * weights, count)
+    return xyz / total[:, None], rgb / total[:, None], total
+
+def merge_chunked(xyz, rgb, origin, size, hi, chunk_size):
+    # level 0 straight from the float32 cloud, one float64 chunk at a time:
+    # partial sums per chunk are folded together whenever they outgrow the running result
+    dims = np.floor((hi - origin) / size).astype(np.int64) + 1
+    fold = lambda parts: sum_voxels(*(np.concatenate(arrays) for arrays in zip(*parts)))
+    merged, pending = [], []
+    for start in range(0, len(xyz), chunk_size):
+        chunk = np.asarray(xyz[start:start + chunk_size], dtype=np.float64)
+        colors = np.asarray(rgb[start:start + chunk_size], dtype=np.float64)
+        pending.append(sum_voxels(voxel_keys(chunk, origin, size, dims), chunk, colors, np.ones(len(chunk))))
+        if sum(len(part[0]) for part in pending) > max(chunk_size, len(merged[0][0]) if merged else 0):
+            merged, pending = [fold(merged + pending)], []
+    _, xyz, rgb, total = fold(merged + pending)
+    return xyz / total[:, None], rgb / total[:, None], total
+
+
+class VoxelPyramid(object):
+    # mean position, colour and count per voxel, the voxel size doubling per level
+
+    def __init__(self, sizes, xyz, rgb, count, num_points):
+        self.sizes = [float(size) for size in sizes]
+        self.xyz = list(xyz)
+        self.rgb = list(rgb)
+        self.count = list(count)
+        self.num_points = int(num_points)
+
+    @classmethod
+    def build(cls, xyz, rgb, voxel_size=None, min_points=None, chunk_size=None):
+        n = len(xyz)
+        min_points = config.LOD_MIN_POINTS if min_points is None else min_points
+        chunk_size = chunk_size or config.POINTCLOUD_CHUNK_SIZE
+        if n == 0:
+            return cls([], [], [], [], 0)
+
+        origin = xyz.min(axis=0).astype(np.float64)
+        hi = xyz.max(axis=0).astype(np.float64)
+        if voxel_size is None:
+            area = max(float(np.prod(hi[:2] - origin[:2])), 1e-6)
+            voxel_size = np.sqrt(area * config.LOD_POINTS_PER_VOXEL / n)
+
+        size = max(float(voxel_size), 1e-6)
+        sizes, levels = [], []
+        while True:
+            if not levels:
+                level_xyz, level_rgb, level_count = merge_chunked(xyz, rgb, origin, size, hi, chunk_size)
+            else:
+                # the levels above are a fraction of the cloud and merge in memory
+                level_xyz, level_rgb, level_count = merge_voxels(level_xyz, level_rgb, level_count, origin, size)
+            sizes.append(size)
+            levels.append((
+                level_xyz.astype(np.float32),
+                np.clip(np.round(level_rgb), 0, 255).astype(np.uint8),
+                level_count.astype(np.uint32),
+            ))
+            if len(level_count) <= max(min_points, 1):
+                break
+            size *= 2
+
+        xyz, rgb, count = zip(*levels)
+        return cls(sizes, xyz, rgb, count, n)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def level(self, budget=None, resolution=None):
+        # None when the full cloud already fits
+        if budget is not None:
+            if budget >= self.num_points:
+                return None
+            for level, count in enumerate(self.count):
+                if len(count) <= budget:
+                    return level
+            return len(self) - 1 if len(self) else None
+        if resolution is not None:
+            fits = [level for level, size in enumerate(self.sizes) if size <= resolution]
+            return fits[-1] if fits else None
+        return None
+
+    def save(self, filename):
+        arrays = {'sizes': np.array(self.sizes), 'num_points': self.num_points}
+        for level in range(len(self)):
+            arrays[f'xyz_{level}'] = self.xyz[level]
+            arrays[f'rgb_{level}'] = self.rgb[level]
+            arrays[f'count_{level}'] = self.count[level]
+        part = part_path(filename)
+        with open(part, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(part, filename)
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        levels = range(len(data['sizes']))
+        return cls(
+            data['sizes'],
+            [data[f'xyz_{level}'] for level in levels],
+            [data[f'rgb_{level}'] for level in levels],
+            [data[f'count_{level}'] for level in levels],
+            data['num_points'],
+        )
+
+    def __repr__(self):
+        return f'voxel pyramid of {self.num_points} points, levels ' + ', '.join(
+            f'{size:g}m/{len(count)}' for size, count in zip(self.sizes, self.count))
@@ -1,24 +1,32 @@
 from dataclasses import dataclass
 import numpy as np
-import requests
 import sys
 from .config import config
+from .http_util import client
 
 @dataclass
 class Api:
     plan_id: None
     headers: None
     
-    def get(self, endpoint):
-
+    def url(self, endpoint):
         if endpoint == 'plan':
-            url = f'https://{config.PREFIX}.dronedeploy.com/api/v1/plan/{self.plan_id}'
-            response = requests.get(url, headers=self.headers)
-            response = response.json()
+            return f'https://{config.PREFIX}.dronedeploy.com/api/v1/plan/{self.plan_id}'
+        if endpoint == 'camfile':
+            return f'https://{config.PREFIX}.dronedeploy.com/api/v1/camfile/{self.plan_id}'
+        raise ValueError(f"unknown endpoint {endpoint}")
 
-            if response.get('code') is not None:
-                print(response.get("message"))
-                sys.exit(0)
+    def request(self, endpoint, headers=None):
+        # raw response, so callers can send conditional headers and see a 304
+        headers = dict(self.headers, **(headers or {}))
+        return client.get(self.url(endpoint), headers=headers)
 
-            return response
+    def check(self, response):
+        if response.get('code') is not None:
+            print(response.get("message"))
+            sys.exit(0)
+        return response
 
+    def get(self, endpoint):
+        response = self.request(endpoint)
+        return self.check(response.json())
@@ -1,110 +1,577 @@
 import numpy as np
-import pymap3d, laspy, os
+import pymap3d, laspy, os, threading, json, hashlib, shutil
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
 from .conv_utils import lla2enu
+from .spatial_util import GridIndex, footprint_bbox
+from .depth_util import DepthBuffer, splat
+from .vote_util import MaskVotes
+from .lod_util import VoxelPyramid
+from .tile_util import TileSet
+from .cache_util import write_atomic, file_sha256, part_path
+from .config import config
+
+
+def compact_paths(numpycloud):
+    # float32 ENU coordinates and uint8 colours, 15 bytes per point
+    numpycloud = str(numpycloud)
+    return numpycloud.replace(".npy", ".xyz.npy"), numpycloud.replace(".npy", ".rgb.npy")
+
+def lla_to_enu_chunk(lla, Rinv, Sinv, T):
+    # module level so it can be sent to a process pool
+    return lla2enu(lla, Rinv, Sinv, T).astype(np.float32)
+
+def distort(x, K, distortion):
+    # normalised camera coordinates (N x 2, overwritten) to pixels
+    x2 = x[:, 0] * x[:, 0]
+    y2 = x[:, 1] * x[:, 1]
+    xy = x[:, 0] * x[:, 1]
+    r2 = x2 + y2
+
+    k1, k2, k3, k4, p1, p2 = distortion
+    # radial distortion coefficient
+    coeff = 1.0 + r2 * (k1 + r2 * (k2 + r2 * (k3 + r2 * k4)))
+    # tangential
+    x[:, 0] = x[:, 0] * coeff + p1 * xy * 2.0 + p2 * (r2 + x2 * 2.0)
+    x[:, 1] = x[:, 1] * coeff + p1 * (r2 + y2 * 2.0) + p2 * xy * 2.0
+
+    x[:, 0] = K[0, 2] + K[0, 0] * x[:, 0]
+    x[:, 1] = K[1, 2] + K[1, 1] * x[:, 1]
+
+    return x
+
+_scratch = threading.local()
+
+def project_chunk(points, R, t, K, distortion, out, chunk_size):
+    n = len(points)
+    dtype = out.dtype
+    buffers = getattr(_scratch, 'buffers', None)
+    if buffers is None or buffers.shape[1] < chunk_size or buffers.dtype != dtype:
+        buffers = _scratch.buffers = np.empty((9, chunk_size), dtype=dtype)
+    cam = buffers[:3, :n].T
+    x2, y2, xy, r2, coeff, tmp = buffers[3:, :n]
+    x, y = out[:, 0], out[:, 1]
+
+    np.matmul(points, R, out=cam)
+    cam += t
+    np.divide(cam[:, 0], cam[:, 2], out=x)
+    np.divide(cam[:, 1], cam[:, 2], out=y)
+
+    np.multiply(x, x, out=x2)
+    np.multiply(y, y, out=y2)
+    np.multiply(x, y, out=xy)
+    np.add(x2, y2, out=r2)
+
+    k1, k2, k3, k4, p1, p2 = distortion
+    # radial distortion coefficient, 1 + r2 * (k1 + r2 * (k2 + r2 * (k3 + r2 * k4)))
+    np.multiply(r2, k4, out=coeff)
+    coeff += k3
+    coeff *= r2
+    coeff += k2
+    coeff *= r2
+    coeff += k1
+    coeff *= r2
+    coeff += 1.0
+
+    # tangential, p1 * xy * 2 + p2 * (r2 + x2 * 2)
+    np.multiply(x2, 2.0, out=tmp)
+    tmp += r2
+    tmp *= p2
+    x *= coeff
+    x += tmp
+    np.multiply(xy, 2.0 * p1, out=tmp)
+    x += tmp
+
+    # p1 * (r2 + y2 * 2) + p2 * xy * 2
+    np.multiply(y2, 2.0, out=tmp)
+    tmp += r2
+    tmp *= p1
+    y *= coeff
+    y += tmp
+    np.multiply(xy, 2.0 * p2, out=tmp)
+    y += tmp
+
+    x *= K[0, 0]
+    x += K[0, 2]
+    y *= K[1, 1]
+    y += K[1, 2]
+    return out
+
+def metadata_path(numpycloud):
+    return str(numpycloud).replace(".npy", ".meta.json")
+
+def transform_fingerprint(Rinv, Sinv, T):
+    sha = hashlib.sha256()
+    for value in (Rinv, Sinv, T):
+        sha.update(np.asarray(value, dtype=np.float64).tobytes())
+    return sha.hexdigest()
+
+def source_stats(pointsfile, sha256=None):
+    stat = os.stat(pointsfile)
+    return {
+        'path': os.path.basename(pointsfile),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'sha256': sha256 or file_sha256(pointsfile),
+    }
+
+def read_metadata(metafile):
+    try:
+        return json.load(open(metafile))
+    except (OSError, ValueError):
+        # missing or corrupt, rewritten from the arrays
+        return None
+
+def write_metadata(metafile, xyzfile, rgbfile, pointsfile, fingerprint, chunk_size=None):
+    chunk_size = chunk_size or config.POINTCLOUD_CHUNK_SIZE
+    xyz = np.load(xyzfile, mmap_mode='r')
+    rgb = np.load(rgbfile, mmap_mode='r')
+
+    lo, hi = np.full(3, np.inf), np.full(3, -np.inf)
+    for start in range(0, len(xyz), chunk_size):
+        chunk = np.asarray(xyz[start:start + chunk_size])
+        lo = np.minimum(lo, chunk.min(axis=0))
+        hi = np.maximum(hi, chunk.max(axis=0))
+
+    meta = {
+        'count': int(len(xyz)),
+        'bounds': [float(lo[0]), float(lo[1]), float(hi[0]), float(hi[1])] if len(xyz) else None,
+        'zrange': [float(lo[2]), float(hi[2])] if len(xyz) else None,
+        'dtype': {'xyz': str(xyz.dtype), 'rgb': str(rgb.dtype)},
+        'source': source_stats(pointsfile) if os.path.exists(pointsfile) else None,
+        'transform': fingerprint,
+    }
+    del xyz, rgb
+    write_atomic(metafile, json.dumps(meta, indent=2).encode())
+    return meta
+
+def remove_cache(numpycloud):
+    # everything derived from the ENU points, they are all rebuilt on demand
+    base = str(numpycloud).replace(".npy", "")
+    for suffix in ('.xyz.npy', '.rgb.npy', '.meta.json', '.index.npz', '.lod.npz'):
+        if os.path.exists(base + suffix):
+            os.remove(base + suffix)
+    shutil.rmtree(base + '.tiles', ignore_errors=True)
+    shutil.rmtree(os.path.join(os.path.dirname(base), 'depth'), ignore_errors=True)
+
+def save_atomic(filename, array):
+    part = part_path(filename)
+    with open(part, 'wb') as f:
+        np.save(f, array)
+    os.replace(part, filename)
 
 
 @dataclass
 class PointCloud:
-    def __init__(self, pointcloud, transform):
+    def __init__(self, pointcloud, transform, tile_size=None, cache=None):
         numpycloud = str(pointcloud).replace(".las", ".npy")
-        self.las2numpy(transform.Rinv, transform.Sinv, transform.T, pointcloud, numpycloud)
+        # the on-disk cache this cloud was loaded from, None once cropped
+        self.source = numpycloud
+        # CacheManager told about every derived file read or rebuilt, for its LRU order and hit rate
+        self.cache = cache
+        self._xyz = self._rgb = None
+        self.init_locks()
+        self.reset_derived()
+        self.las2numpy(transform.Rinv, transform.Sinv, transform.T, pointcloud, numpycloud, tile_size)
+
+    @staticmethod
+    def is_cached(pointcloud, transform):
+        # the compact ENU cache and a sidecar matching `transform` are on disk
+        numpycloud = str(pointcloud).replace(".las", ".npy")
+        meta = read_metadata(metadata_path(numpycloud))
+        if meta is None or meta['transform'] != transform_fingerprint(transform.Rinv, transform.Sinv, transform.T):
+            return False
+        return all(os.path.exists(path) for path in compact_paths(numpycloud))
+
+    @classmethod
+    def from_arrays(cls, xyz, rgb=None):
+        cloud = cls.__new__(cls)
+        cloud.source = None
+        cloud.cache = None
+        cloud.init_locks()
+        cloud.reset_derived()
+        cloud._xyz = np.asarray(xyz, dtype=np.float32)
+        cloud._rgb = np.zeros(cloud._xyz.shape, dtype=np.uint8) if rgb is None else np.asarray(rgb, dtype=np.uint8)
+        return cloud
         
     def read_points(self, filename, is_wgs84=False):
         f = laspy.read(filename)
         points = np.vstack([ f.x, f.y, f.z, f.red / 256, f.green / 256, f.blue / 256, ]).T
         return points
 
-    def las2numpy(self, Rinv, Sinv, T, pointsfile, numpycloud):
-        if os.path.exists(numpycloud):
-            self.points = np.load(numpycloud)
-            return 
-        
-        print("loading pointcloud")
-        points = self.read_points(pointsfile)
-        print(f"loaded {points.shape} points")
-        print("converting to enu")
-        colors = points[:, -3:]
-        points = lla2enu(points, Rinv, Sinv, T)
-        points = np.hstack([points, colors])
-        print("saving npy", points.shape)
-        np.save(numpycloud, points)
-        self.points = points
+    def las2numpy(self, Rinv, Sinv, T, pointsfile, numpycloud, tile_size=None):
+        xyzfile, rgbfile = compact_paths(numpycloud)
+        metafile = metadata_path(numpycloud)
+        fingerprint = transform_fingerprint(Rinv, Sinv, T)
+
+        meta = read_metadata(metafile)
+        if meta is not None and (meta['transform'] != fingerprint or self.source_changed(meta, metafile, pointsfile)):
+            print("rebuilding stale point cloud cache", numpycloud)
+            remove_cache(numpycloud)
+            meta = None
+
+        if not (os.path.exists(xyzfile) and os.path.exists(rgbfile)):
+            meta = None
+            if os.path.exists(numpycloud):
+                # N x 6 float64 cache written by earlier versions
+                print("compacting", numpycloud)
+                points = np.load(numpycloud, mmap_mode='r')
+                save_atomic(xyzfile, points[:, :3].astype(np.float32))
+                save_atomic(rgbfile, np.clip(points[:, -3:], 0, 255).astype(np.uint8))
+                del points
+                os.remove(numpycloud)
+            else:
+                self.convert_las(Rinv, Sinv, T, pointsfile, xyzfile, rgbfile)
+
+        if meta is None:
+            # also adopts caches written before the sidecar existed
+            meta = write_metadata(metafile, xyzfile, rgbfile, pointsfile, fingerprint)
+        self.meta = meta
+
+        tilefolder = numpycloud.replace(".npy", ".tiles")
+        if (tile_size or config.POINTCLOUD_TILED) and not TileSet.exists(tilefolder):
+            TileSet.write(self.xyz, self.rgb, tilefolder, tile_size)
+
+    def source_changed(self, meta, metafile, pointsfile):
+        # the LAS is only hashed when its size or mtime moved, a missing LAS counts as unchanged
+        source = meta.get('source')
+        if source is None or not os.path.exists(pointsfile):
+            return False
+        stat = os.stat(pointsfile)
+        if stat.st_size == source['size'] and stat.st_mtime == source['mtime']:
+            return False
+        if file_sha256(pointsfile) != source['sha256']:
+            return True
+        # re-extracted with the same content
+        meta['source'] = source_stats(pointsfile, source['sha256'])
+        write_atomic(metafile, json.dumps(meta, indent=2).encode())
+        return False
+
+    # memory mapped on first access, so processes opening the same cloud
+    # share the page cache and opening a cloud reads only its sidecar
+    @property
+    def xyz(self):
+        if self._xyz is None:
+            self._xyz = np.load(compact_paths(self.source)[0], mmap_mode='r')
+        return self._xyz
+
+    @xyz.setter
+    def xyz(self, xyz):
+        self.detach()
+        self._xyz = xyz
+
+    @property
+    def rgb(self):
+        if self._rgb is None:
+            self._rgb = np.load(compact_paths(self.source)[1], mmap_mode='r')
+        return self._rgb
+
+    @rgb.setter
+    def rgb(self, rgb):
+        self.detach()
+        self._rgb = rgb
+
+    def convert_las(self, Rinv, Sinv, T, pointsfile, xyzfile, rgbfile, chunk_size=None, workers=None):
+        # chunks are converted on a process pool straight into the memory mapped output
+        chunk_size = chunk_size or config.POINTCLOUD_CHUNK_SIZE
+        workers = workers or config.POINTCLOUD_WORKERS or os.cpu_count()
+
+        xyzpart, rgbpart = part_path(xyzfile), part_path(rgbfile)
+        pool = None
+        try:
+            with laspy.open(pointsfile) as reader:
+                count = reader.header.point_count
+                print(f"converting {count} points to enu")
+
+                xyz = np.lib.format.open_memmap(xyzpart, mode='w+', dtype=np.float32, shape=(count, 3))
+                rgb = np.lib.format.open_memmap(rgbpart, mode='w+', dtype=np.uint8, shape=(count, 3))
+
+                pool = ProcessPoolExecutor(max_workers=workers) if count > chunk_size and workers > 1 else None
+                pending = deque()
+
+                def write(offset, enu):
+                    xyz[offset:offset + len(enu)] = enu
+
+                offset = 0
+                for chunk in reader.chunk_iterator(chunk_size):
+                    lla = np.vstack([chunk.x, chunk.y, chunk.z]).T
+                    # same as the old red / 256 floats truncated to 8 bits
+                    rgb[offset:offset + len(chunk)] = np.vstack([chunk.red, chunk.green, chunk.blue]).T // 256
+
+                    if pool is None:
+                        write(offset, lla_to_enu_chunk(lla, Rinv, Sinv, T))
+                    else:
+                        pending.append((offset, pool.submit(lla_to_enu_chunk, lla, Rinv, Sinv, T)))
+                        # bound the number of chunks held in memory
+                        while len(pending) >= 2 * workers:
+                            done, future = pending.popleft()
+                            write(done, future.result())
+                    offset += len(chunk)
+
+                while pending:
+                    done, future = pending.popleft()
+                    write(done, future.result())
+
+            xyz.flush()
+            rgb.flush()
+            del xyz, rgb
+        except BaseException:
+            # a failed chunk leaves no half written parts behind
+            for part in (xyzpart, rgbpart):
+                if os.path.exists(part):
+                    os.remove(part)
+            raise
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+        os.replace(xyzpart, xyzfile)
+        os.replace(rgbpart, rgbfile)
+        print("saved", xyzfile)
+
+    @classmethod
+    def from_tiles(cls, folder, bbox=None, polygon=None, camera=None, margin=0, cache=None):
+        # whole tiles, crop the result for an exact selection
+        tiles = TileSet.load(folder)
+        if bbox is not None:
+            selected = tiles.select_bbox(*bbox)
+        elif polygon is not None:
+            selected = tiles.select_polygon(*polygon)
+        elif camera is not None:
+            selected = tiles.select_frustum(camera, margin)
+        else:
+            selected = tiles.tiles
+        print(f"loading {len(selected)} of {len(tiles.tiles)} tiles")
+        if cache is not None:
+            for tile in selected:
+                for kind in ('xyz', 'rgb'):
+                    cache.hit(os.path.join(folder, f"{tile['name']}.{kind}.npy"))
+        return cls.from_arrays(*tiles.read(selected))
+
+    @property
+    def tilefolder(self):
+        return None if self.source is None else self.source.replace(".npy", ".tiles")
+
+    def region(self, bbox=None, polygon=None, camera=None, margin=0):
+        if self.tilefolder is None:
+            raise ValueError("only clouds loaded from the ENU cache are tiled")
+        if not TileSet.exists(self.tilefolder):
+            TileSet.write(self.xyz, self.rgb, self.tilefolder)
+        return PointCloud.from_tiles(self.tilefolder, bbox, polygon, camera, margin, self.cache)
+
+    def view(self, index=None):
+        return PointCloudView(self, np.arange(self.num_points) if index is None else index)
+
+    def keep(self, selection):
+        xyz, rgb = self.xyz[selection], self.rgb[selection]
+        self.detach()
+        self._xyz, self._rgb = xyz, rgb
+
+    def detach(self):
+        # new points are no longer the ones the cache, its sidecar and index describe
+        if self.source is not None:
+            self._xyz, self._rgb = self.xyz, self.rgb
+        self.source = None
+        self.reset_derived()
+
+    def init_locks(self):
+        # the lazy structures below are shared by the vote and render threads,
+        # each is built once under its own lock
+        self._index_lock = threading.Lock()
+        self._pyramid_lock = threading.Lock()
+        self._memo_lock = threading.Lock()
+
+    def reset_derived(self):
+        # structures computed from the points, rebuilt on demand
+        self._index = None
+        self._depth = OrderedDict()
+        self._votes = None
+        self._pyramid = None
+        self._lod = {}
+        # sidecar of the on-disk cache, see write_metadata
+        self.meta = None
+
+    def accessed(self, path, hit=True):
+        if self.cache is not None and path is not None:
+            (self.cache.hit if hit else self.cache.miss)(path)
+
+    @property
+    def indexfile(self):
+        return None if self.source is None else self.source.replace(".npy", ".index.npz")
+
+    @property
+    def index(self):
+        if self._index is None:
+            with self._index_lock:
+                if self._index is None:
+                    self._index = self.load_index()
+        return self._index
+
+    def load_index(self):
+        if self.indexfile is not None and os.path.exists(self.indexfile):
+            index = GridIndex.load(self.indexfile)
+            if index.num_points == self.num_points:
+                self.accessed(self.indexfile)
+                return index
+
+        self.accessed(self.indexfile, hit=False)
+        print("building spatial index")
+        index = GridIndex.build(self.xyz)
+        if self.indexfile is not None:
+            index.save(self.indexfile)
+        return index
+
+    @property
+    def pyramidfile(self):
+        return None if self.source is None else self.source.replace(".npy", ".lod.npz")
+
+    @property
+    def pyramid(self):
+        if self._pyramid is None:
+            with self._pyramid_lock:
+                if self._pyramid is None:
+                    self._pyramid = self.load_pyramid()
+        return self._pyramid
+
+    def load_pyramid(self):
+        if self.pyramidfile is not None and os.path.exists(self.pyramidfile):
+            pyramid = VoxelPyramid.load(self.pyramidfile)
+            if pyramid.num_points == self.num_points:
+                self.accessed(self.pyramidfile)
+                return pyramid
+
+        self.accessed(self.pyramidfile, hit=False)
+        print("building voxel pyramid")
+        pyramid = VoxelPyramid.build(self.xyz, self.rgb)
+        if self.pyramidfile is not None:
+            pyramid.save(self.pyramidfile)
+        return pyramid
+
+    def lod(self, budget=None, resolution=None):
+        # self when it already fits
+        level = self.pyramid.level(budget, resolution)
+        if level is None:
+            return self
+        with self._memo_lock:
+            if level not in self._lod:
+                self._lod[level] = PointCloud.from_arrays(self.pyramid.xyz[level], self.pyramid.rgb[level])
+            return self._lod[level]
+
+    def query_bbox(self, xmin, ymin, xmax, ymax):
+        return np.sort(self.index.query_bbox(self.xyz, xmin, ymin, xmax, ymax))
+
+    def query_polygon(self, x, y):
+        return np.sort(self.index.query_polygon(self.xyz, x, y))
+
+    def label_areas(self, areas):
+        # -1 for points outside every area
+        return self.index.label_polygons(self.xyz, areas)
+
+    def query_areas(self, areas):
+        return np.where(self.label_areas(areas) >= 0)[0]
+
+    def crop_areas(self, areas):
+        labels = self.label_areas(areas)
+        inside = np.where(labels >= 0)[0]
+        self.keep(inside)
+        return labels[inside]
+
+    def query_radius(self, center, radius):
+        return np.sort(self.index.query_radius(self.xyz, center, radius))
+
+    def query_knn(self, center, k):
+        return self.index.query_knn(self.xyz, center, k)
+
+    def cone_candidates(self, camera, xy, _pixel_buffer):
+        # None when the cone reaches the horizon
+        x, y = xy
+        b = _pixel_buffer
+        border = [[x + dx, y + dy] for dx in (-b, 0, b) for dy in (-b, 0, b) if dx or dy]
+        return self.footprint_candidates(camera, border)
+
+    def frustum_candidates(self, camera, margin=0):
+        # as cone_candidates, for the whole image
+        return self.footprint_candidates(camera, camera.border(margin))
+
+    def footprint_candidates(self, camera, border):
+        bbox = footprint_bbox(camera, border, self.index.zrange)
+        if bbox is None:
+            return None
+        return np.sort(self.index.candidates(*bbox))
+
+    @property
+    def points(self):
+        # materialises the old N x 6 float64 layout, prefer xyz and rgb
+        return np.hstack([self.xyz, self.rgb]).astype(np.float64)
+
+    @points.setter
+    def points(self, points):
+        self.detach()
+        self._xyz = np.asarray(points[:, :3], dtype=np.float32)
+        self._rgb = np.clip(points[:, -3:], 0, 255).astype(np.uint8)
 
     @property
     def num_points(self):
-        return self.points.shape[0]
+        if self.meta is not None:
+            return self.meta['count']
+        return self.xyz.shape[0]
     
     @property
     def colors(self):
-        return self.points[:, -3:]
+        return self.rgb
     
     @property
     def bounds(self):
+        if self.meta is not None:
+            return list(self.meta['bounds'])
         return [
-            self.points[:, 0].min(),
-            self.points[:, 1].min(),
-            self.points[:, 0].max(),
-            self.points[:, 1].max(),
+            self.xyz[:, 0].min(),
+            self.xyz[:, 1].min(),
+            self.xyz[:, 0].max(),
+            self.xyz[:, 1].max(),
         ]
     
-    def crop_mask(self):
-        perc = np.array(self.vote) / np.array(self.total)
-        perc = np.where(perc > 0.8)
-        self.points = self.points[perc, :]
-    
+    @property
+    def votes(self):
+        with self._memo_lock:
+            if self._votes is None:
+                self._votes = MaskVotes(self.num_points)
+            return self._votes
+
+    def vote_masks(self, pairs, threshold=None, workers=None, return_index=False):
+        self.votes.add(self, pairs, workers)
+        if return_index:
+            return self.votes.keep_index(threshold)
+        return self.votes.keep_mask(threshold)
+
+    def crop_mask(self, threshold=None):
+        self.keep(self.votes.keep_index(threshold))
+
     def crop_mask_update(self, camera, mask):
-        projected = self.project(camera)
-        projected = (0.5 + projected).astype('int')
-        # k1 = projected[:, 0] > 0
-        # k2 = projected[:, 0] < camera.width
-        # k3 = projected[:, 1] > 0
-        # k4 = projected[:, 1] < camera.height
-        # projected = projected[k1 & k2 & k3 & k4, :]
-
-        keep = []
-        for index, xy in enumerate(projected):
-            x, y = xy
-
-            if x < 0 or y < 0 or x >= camera.width or y >= camera.height:
-                continue
-            if mask[y, x] == 255:
-                self.vote[index] += 1
-
-            self.total[index] += 1
-
-        perc = np.array(self.vote) / np.array(self.total)
-        perc = np.where(perc > 0.8)
-        print(len(perc[0]), self.points.shape)
-            
-        # print(self.points.shape)
-        # self.points = self.points[ keep, :]
-        # print(self.points.shape)
-        # projected = projected[:, [1, 0]]
-        # print(projected)
-        # print(projected.max(axis=0))
-        # print(camera.width, camera.height)        
-        
-        # view = np.zeros_like(mask)
-        # print(view.shape)
-        # view[projected[:, 0], projected[:, 1]] = 255
-        # import cv2
-        # cv2.imwrite("view.png", view)
+        keep = self.vote_masks([(camera, mask)])
+        print(np.count_nonzero(keep), self.xyz.shape)
 
-    def crop_xy(self, camera, xy, _pixel_buffer=15, return_value=False):
+    def query_xy(self, camera, xy, _pixel_buffer=15):
         x, y = xy
 
-        projected = self.project(camera)
+        candidates = self.cone_candidates(camera, xy, _pixel_buffer)
+        points = self.xyz if candidates is None else self.xyz[candidates]
+        projected = self.project(camera, points)
 
         k1 = projected[:, 0] > x - _pixel_buffer
         k2 = projected[:, 0] < x + _pixel_buffer
         k3 = projected[:, 1] > y - _pixel_buffer
         k4 = projected[:, 1] < y + _pixel_buffer
+        selection = k1 & k2 & k3 & k4
+        return np.where(selection)[0] if candidates is None else candidates[selection]
 
+    def crop_xy(self, camera, xy, _pixel_buffer=15, return_value=False):
+        selection = self.query_xy(camera, xy, _pixel_buffer)
         if return_value:
-            return self.points[k1 & k2 & k3 & k4, :3]
+            return self.xyz[selection]
         else:
-            self.points = self.points[k1 & k2 & k3 & k4, :]
+            self.keep(selection)
 
     def ray_cast(self, camera, xy, _pixel_buffer=5):
         cone = self.crop_xy(camera, xy, return_value=True)
@@ -117,21 +584,93 @@ class PointCloud:
         #         best_ray = cone_element
         return np.array( [ best_ray.tolist() ])
     
+    def depth_buffer(self, camera, scale=None):
+        scale = scale or config.DEPTH_SCALE
+        key = (camera.image, scale)
+        with self._memo_lock:
+            if key in self._depth:
+                self._depth.move_to_end(key)
+                return self._depth[key]
+
+        # rendered outside the lock, two threads asking for the same view at once both render it
+        filename = DepthBuffer.filename(camera, scale) if self.source is not None else None
+        buffer = None
+        if filename is not None and filename.exists():
+            buffer = DepthBuffer.load(filename)
+            if buffer.num_points != self.num_points:
+                buffer = None
+            else:
+                self.accessed(filename)
+        if buffer is None:
+            self.accessed(filename, hit=False)
+            buffer = DepthBuffer.render(self, camera, scale)
+            if filename is not None:
+                buffer.save(filename)
+
+        with self._memo_lock:
+            self._depth[key] = buffer
+            while len(self._depth) > config.DEPTH_MEMO:
+                self._depth.popitem(last=False)
+        return buffer
+
+    def ray_cast_many(self, camera, xys, _pixel_buffer=15, mode='median'):
+        # NaN rows for pixels that see no points
+        xys = np.atleast_2d(np.asarray(xys, dtype=np.float64))
+        ret = np.full((len(xys), 3), np.nan)
+        if len(xys) == 0:
+            return ret
+
+        if mode == 'depth':
+            index = self.depth_buffer(camera).lookup(xys)
+            ret[index >= 0] = self.xyz[index[index >= 0]]
+            return ret
+
+        cones = [self.cone_candidates(camera, xy, _pixel_buffer) for xy in xys]
+        if any(cone is None for cone in cones):
+            candidates = np.arange(self.num_points)
+        else:
+            candidates = np.unique(np.concatenate(cones))
+
+        projected = self.project(camera, self.xyz[candidates])
+        lo = xys.min(axis=0) - _pixel_buffer
+        hi = xys.max(axis=0) + _pixel_buffer
+        near = np.all((projected > lo) & (projected < hi), axis=1)
+        candidates, projected = candidates[near], projected[near]
+
+        # buckets as wide as a window, so a window overlaps at most 2 x 2 of them
+        size = 2.0 * _pixel_buffer
+        columns = int((hi[0] - lo[0]) // size) + 1
+        cells = ((projected - lo) // size).astype(np.int64)
+        cells = cells[:, 1] * columns + cells[:, 0]
+        order = np.argsort(cells, kind='stable')
+        cells = cells[order]
+
+        for row, (x, y) in enumerate(xys):
+            cx0, cy0 = ((np.array([x, y]) - _pixel_buffer - lo) // size).astype(np.int64)
+            found = []
+            for cy in (cy0, cy0 + 1):
+                begin, end = np.searchsorted(cells, [cy * columns + cx0, cy * columns + cx0 + 2])
+                found.append(order[begin:end])
+            found = np.concatenate(found)
+            window = np.all(np.abs(projected[found] - [x, y]) < _pixel_buffer, axis=1)
+            if np.any(window):
+                ret[row] = np.median(self.xyz[candidates[found[window]]], axis=0)
+        return ret
+
+    def query_enu(self, x, y, approx=True):
+        if approx:
+            return self.query_bbox(x.min(), y.min(), x.max(), y.max())
+        return self.query_polygon(x, y)
+
     def crop_enu(self, x, y, approx=True):
-        
-        k1 = self.points[:, 0] > x.min()
-        k2 = self.points[:, 0] < x.max()
-        k3 = self.points[:, 1] > y.min()
-        k4 = self.points[:, 1] < y.max()
-        self.points = self.points[k1 & k2 & k3 & k4, :]
-        if not approx:
-            from shapely.geometry import Polygon, Point
-            polygon = Polygon( zip(x, y) )
-            self.points = np.array([ point for point in self.points if polygon.contains(Point(point[0], point[1]))])
+        self.keep(self.query_enu(x, y, approx))
     
-    def display(self, cameras=None):
+    def display(self, cameras=None, budget=None):
         import open3d as o3d
 
+        # preview a large cloud from the voxel pyramid
+        cloud = self if budget is None else self.lod(budget=budget)
+
         if cameras is not None:
             vis = o3d.visualization.Visualizer()
         else:
@@ -141,8 +680,8 @@ class PointCloud:
         opt = vis.get_render_option()
         opt.background_color = np.asarray([0.0, 0.0, 0.0])
         pcd = o3d.geometry.PointCloud()
-        pcd.points = o3d.utility.Vector3dVector(self.points[:, :3])
-        pcd.colors = o3d.utility.Vector3dVector(self.points[:, -3:] / 256.)
+        pcd.points = o3d.utility.Vector3dVector(np.asarray(cloud.xyz, dtype=np.float64))
+        pcd.colors = o3d.utility.Vector3dVector(cloud.rgb / 256.)
         vis.add_geometry(pcd)
         if cameras is not None:
             camera_points = []
@@ -210,57 +749,138 @@ class PointCloud:
             for pick in picked:
                 print(pcd.points[pick])
 
-    def project(self, camera):
+    def project(self, camera, points=None, dtype=np.float64, chunk_size=None, workers=None, out=None):
+        points = self.xyz if points is None else points
+        chunk_size = chunk_size or config.PROJECT_CHUNK_SIZE
+        workers = workers or config.PROJECT_WORKERS or os.cpu_count()
 
-        pose = camera.transform
+        pose = np.asarray(camera.transform)
+        R = pose[:3, :3].T.astype(dtype)
+        t = pose[:3, 3].astype(dtype)
         K = camera.K
         distortion = camera.distortion
-        points = self.points[:, :3]
 
-        p = np.hstack( (points, np.ones((self.num_points, 1)))).T
+        n = len(points)
+        out = np.empty((n, 2), dtype=dtype) if out is None else out
+
+        def run(start):
+            end = min(start + chunk_size, n)
+            project_chunk(points[start:end], R, t, K, distortion, out[start:end], chunk_size)
 
-        x = pose.dot(p)
-        x = x.T
-        x = np.asarray(x)
+        starts = range(0, n, chunk_size)
+        if len(starts) <= 1 or workers <= 1:
+            for start in starts:
+                run(start)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(run, starts))
 
-        # check behind?
-        x[:, 0] /= x[:, 2]
-        x[:, 1] /= x[:, 2]
-        x = x[:, :2]
+        # no check for points behind the camera, see project_visible
+        return out
 
-        # distort X
-        x2 = x[:, 0] * x[:, 0]
-        y2 = x[:, 1] * x[:, 1]
-        xy = x[:, 0] * x[:, 1]
-        r2 = x2 + y2
+    def project_visible(self, camera, margin=0):
+        candidates = self.frustum_candidates(camera, margin)
+        if candidates is None:
+            candidates = np.arange(self.num_points)
 
-        k1, k2, k3, k4, p1, p2 = distortion
-        # radial distortion coefficient
-        coeff = 1.0 + r2 * (k1 + r2 * (k2 + r2 * (k3 + r2 * k4)))
-        # tangential
-        x[:, 0] = x[:, 0] * coeff + p1 * xy * 2.0 + p2 * (r2 + x2 * 2.0)
-        x[:, 1] = x[:, 1] * coeff + p1 * (r2 + y2 * 2.0) + p2 * xy * 2.0
+        pose = np.asarray(camera.transform, dtype=np.float64)
+        x = self.xyz[candidates].dot(pose[:3, :3].T) + pose[:3, 3]
+        front = x[:, 2] > 0
+        candidates, x = candidates[front], x[front]
 
-        x[:, 0] = K[0, 2] + K[0, 0] * x[:, 0]
-        x[:, 1] = K[1, 2] + K[1, 1] * x[:, 1]
+        normalized = x[:, :2] / x[:, 2:3]
+        bounds = camera.undistort(camera.border(margin))
+        lo, hi = bounds.min(axis=0), bounds.max(axis=0)
+        pad = 0.05 * (hi - lo)
+        inside = np.all((normalized > lo - pad) & (normalized < hi + pad), axis=1)
+        candidates, normalized = candidates[inside], normalized[inside]
 
-        return x
-    
-    def view_from(self, camera):
-        import cv2
-        img = cv2.imread(camera.filename)
-        pcl = np.zeros_like(img)
-        projected = self.project(camera)
-        
-        for index, xy in enumerate(projected):
-            x, y = xy
-            x = int(x + 0.5)
-            y = int(y + 0.5)
-            if x > 0 and x < camera.width and y > 0 and y < camera.height:
-                color = self.points[index, -3:]
-                cv2.circle(pcl, (x, y), 3, color[::-1], -1)    
-        return pcl
+        pixels = distort(normalized, camera.K, camera.distortion)
+        inside = np.all((pixels >= -margin) & (pixels < np.array([camera.width, camera.height]) + margin), axis=1)
+        return pixels[inside], candidates[inside]
     
+    def view_from(self, camera, radius=3):
+        projected, visible = self.project_visible(camera, margin=radius)
+        pose = np.asarray(camera.transform, dtype=np.float64)
+        z = self.xyz[visible].dot(pose[2, :3]) + pose[2, 3]
+        return splat(projected, z, self.rgb[visible][:, ::-1], camera.width, camera.height, radius)
+
+    def view_from_many(self, cameras, radius=3, workers=None):
+        cameras = list(cameras)
+        workers = workers or config.RENDER_WORKERS
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            return list(pool.map(lambda camera: self.view_from(camera, radius), cameras))
+
     def __repr__(self):
-        rep = f'pointcloud {self.points.shape[0]} points'
+        rep = f'pointcloud {self.num_points} points'
         return rep
+
+
+class PointCloudView(object):
+    # indices into a base cloud, crops return narrower views and never touch the base
+
+    def __init__(self, base, index):
+        self.base = base
+        self.index = np.unique(np.asarray(index, dtype=np.int64))
+
+    def narrow(self, selection):
+        # selection is in base indices
+        return PointCloudView(self.base, np.intersect1d(self.index, selection, assume_unique=True))
+
+    def view(self, index=None):
+        return PointCloudView(self.base, self.index if index is None else self.index[index])
+
+    @property
+    def xyz(self):
+        return self.base.xyz[self.index]
+
+    @property
+    def rgb(self):
+        return self.base.rgb[self.index]
+
+    @property
+    def points(self):
+        return np.hstack([self.xyz, self.rgb]).astype(np.float64)
+
+    @property
+    def colors(self):
+        return self.rgb
+
+    @property
+    def num_points(self):
+        return len(self.index)
+
+    @property
+    def bounds(self):
+        xy = self.base.xyz[self.index, :2]
+        return [xy[:, 0].min(), xy[:, 1].min(), xy[:, 0].max(), xy[:, 1].max()]
+
+    def crop_xy(self, camera, xy, _pixel_buffer=15):
+        return self.narrow(self.base.query_xy(camera, xy, _pixel_buffer))
+
+    def crop_enu(self, x, y, approx=True):
+        return self.narrow(self.base.query_enu(x, y, approx))
+
+    def crop_areas(self, areas):
+        return self.narrow(self.base.query_areas(areas))
+
+    def crop_mask(self, threshold=None):
+        return self.narrow(self.base.votes.keep_index(threshold))
+
+    def project(self, camera, **kwargs):
+        return self.base.project(camera, self.xyz, **kwargs)
+
+    def project_visible(self, camera, margin=0):
+        pixels, visible = self.base.project_visible(camera, margin)
+        position = np.clip(np.searchsorted(self.index, visible), 0, max(self.num_points - 1, 0))
+        member = self.index[position] == visible if self.num_points else np.zeros(len(visible), dtype=bool)
+        return pixels[member], position[member]
+
+    def materialize(self):
+        return PointCloud.from_arrays(self.xyz, self.rgb)
+
+    def display(self, cameras=None, budget=None):
+        self.materialize().display(cameras, budget)
+
+    def __repr__(self):
+        return f'view of {self.num_points} of {self.base.num_points} points'
@@ -1,20 +1,27 @@
-import os, json, requests, cv2, click
+import os, json, weakref, threading, requests, cv2, click
 import numpy as np
 
 from pathlib import Path
 from dataclasses import dataclass
 
-from .pointcloud_utils import PointCloud
+from .pointcloud_utils import PointCloud, compact_paths, remove_cache
 from .conv_utils import enu2lla, lla2enu
 from .camera_util import Camera, Sensor, Transform
 from .mesh_util import Mesh
 from .plan_util import Api
 from .issue_utils import Issue
+from .http_util import client
+from .cache_util import CacheManager, CacheManifest, write_atomic
+from .annotation_util import AnnotationWriter, annotation_payload
+from .download_util import download_concurrently, stream_to_file, extract_members
 from .config import config
 
+# the textured OBJ, its material library and the texture images it references
+MESH_SUFFIXES = ('.obj', '.mtl', '.jpg', '.jpeg', '.png')
+
 class Scene(object):
 
-    def __init__(self, plan_id, base_cache_folder):
+    def __init__(self, plan_id, base_cache_folder, lazy=False):
 
         self.plan_id = plan_id
         self.plan = None
@@ -22,6 +29,17 @@ class Scene(object):
         self.sensor = None
         self.cameras = []
         self.base_cache_folder = base_cache_folder
+        self.lazy = lazy
+
+        self._pointcloud = None
+        self._mesh = None
+        self._issue = None
+        self._manifest = None
+        # lazy assets are built once however many threads ask for them first
+        self._pointcloud_lock = threading.Lock()
+        self._mesh_lock = threading.Lock()
+        self._issue_lock = threading.Lock()
+        self.cache = CacheManager(base_cache_folder)
 
         if os.environ.get('DRONEDEPLOY', None) is None:
             print("Please set your 'DRONEDEPLOY' environment variable from the browser")
@@ -36,9 +54,8 @@ class Scene(object):
             "content-type": "application/json",
         }
 
-        self.init()
-        self.issue = Issue(self.plan_id, self.folder_id, self.headers, self.pointcloud, self.transform)
         self.api = Api(self.plan_id, self.headers)
+        self.init()
 
     def init(self):
         self.create_cache()
@@ -49,41 +66,130 @@ class Scene(object):
         
         self.download_cameras()
         print('cameras ........ ', click.style('[OK]', fg='green', bold=True))
-    
-        self.download_images()
-        print('images ......... ', click.style('[OK]', fg='green', bold=True))
-    
-        self.download_pointcloud()
-        print('pointcloud ..... ', click.style('[OK]', fg='green', bold=True))
 
-        self.download_mesh()
-        print('mesh ........... ', click.style('[OK]', fg='green', bold=True))
-        
+        # in lazy mode images, pointcloud and mesh are fetched on first access
+        if not self.lazy:
+            self.prefetch()
+
+        self.cache.evict()
+
+    def close(self):
+        # lets CacheManager evict this plan's assets again, at most once per scene
+        self._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def prefetch(self, images=True, pointcloud=True, mesh=True, workers=None):
+        if images:
+            self.download_images(workers=workers)
+            print('images ......... ', click.style('[OK]', fg='green', bold=True))
+
+        if pointcloud and self._pointcloud is None:
+            self.pointcloud
+            print('pointcloud ..... ', click.style('[OK]', fg='green', bold=True))
+
+        if mesh and self._mesh is None:
+            self.mesh
+            print('mesh ........... ', click.style('[OK]', fg='green', bold=True))
+
+    @property
+    def pointcloud(self):
+        if self._pointcloud is None:
+            with self._pointcloud_lock:
+                if self._pointcloud is None:
+                    self.download_pointcloud()
+        return self._pointcloud
+
+    @property
+    def mesh(self):
+        if self._mesh is None:
+            with self._mesh_lock:
+                if self._mesh is None:
+                    self.download_mesh()
+        return self._mesh
+
+    @property
+    def issue(self):
+        if self._issue is None:
+            with self._issue_lock:
+                if self._issue is None:
+                    self._issue = Issue(self.plan_id, self.folder_id, self.headers, self.pointcloud, self.transform)
+        return self._issue
 
     def create_cache(self):
         path = Path(self.base_cache_folder)
         path.mkdir(exist_ok=True)
         path = Path(self.base_cache_folder) / self.plan_id
         path.mkdir(exist_ok=True)
+        self.cache.open(self.plan_id)
+        # runs on close, when the scene is collected or at exit, without keeping it alive
+        self._release = weakref.finalize(self, self.cache.close, self.plan_id)
 
     @property
     def cache_folder(self):
         return Path(self.base_cache_folder) / self.plan_id
 
+    def cached(self, filename):
+        local = f'{self.cache_folder}/{filename}'
+        if os.path.exists(local):
+            self.cache.hit(local)
+            return True
+        return False
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            self._manifest = CacheManifest(self.cache_folder)
+        return self._manifest
+
+    def fetch_json(self, name, endpoint, ttl=None, on_change=None):
+        # on_change(previous, data) runs when the server copy differs from the cached one
+        cache = f'{self.cache_folder}/{name}'
+        cached = os.path.exists(cache)
+        if cached and self.manifest.fresh(name, ttl):
+            return json.load(open(cache))
+
+        print("revalidating" if cached else "downloading", name)
+        try:
+            response = self.api.request(endpoint, headers=self.manifest.validators(name) if cached else None)
+        except requests.RequestException as e:
+            if not cached:
+                raise
+            print(f"could not revalidate {name}, using cached copy ({e})")
+            return json.load(open(cache))
+        if cached and response.status_code == 304:
+            self.manifest.touch(name)
+            return json.load(open(cache))
+        if cached and not 200 <= response.status_code < 300:
+            # an error that outlasted the retries must not replace a good copy
+            print(f"could not revalidate {name}, using cached copy (HTTP {response.status_code})")
+            return json.load(open(cache))
+
+        data = self.api.check(response.json())
+        previous = json.load(open(cache)) if cached else None
+        write_atomic(cache, response.content)
+        if self.manifest.record(name, response) and cached:
+            print(name, "changed on the server")
+            if on_change is not None:
+                on_change(previous, data)
+        return data
+
     def download_plan(self):
-        cache = f'{self.cache_folder}/plan.json'
-        if os.path.exists(cache):
-            response = json.load(open(cache))
-        else:
-            response = self.api.get('plan')
-            json.dump(response, open(cache, mode='w'))     
-        
+        response = self.fetch_json('plan.json', 'plan', ttl=config.PLAN_TTL, on_change=self.drop_stale_exports)
         self.plan = response
         self.folder_id = self.plan.get('folder_id')
     
-    def download_images(self):
-        for camera_index, camera in enumerate(self.cameras):
-            self.download_image(camera.image)
+    def download_images(self, workers=None):
+        workers = workers or config.DOWNLOAD_WORKERS
+        images = [camera.image for camera in self.cameras]
+        stats = download_concurrently(images, self.download_image, self.cached, workers=workers)
+        if stats.total:
+            print(stats)
+        return stats
 
     def download_image(self, image):
         url = f'https://{config.PREFIX}.dronedeploy.com/api/v2/plans/{self.plan_id}/images/{image}/download?jwt_token={self.auth}'
@@ -107,14 +213,7 @@ class Scene(object):
         ]
         
     def download_cameras(self):
-        cache = f'{self.cache_folder}/cameras.json'
-        if os.path.exists(cache):
-            response = json.load(open(cache))
-        else:
-            print("downloading cameras")
-            response = requests.get(f'https://{config.PREFIX}.dronedeploy.com/api/v1/camfile/{self.plan_id}', headers=self.headers)
-            response = response.json()
-            json.dump(response, open(cache, mode='w'))
+        response = self.fetch_json('cameras.json', 'camfile', ttl=config.CAMERAS_TTL)
 
         sensor_dict = response['sensors'][0]
         W = int(sensor_dict['resolution'].get('width'))
@@ -140,7 +239,7 @@ class Scene(object):
             image = camera_dict.get('image')
 
             if camera_dict.get('enabled'):
-                camera = Camera(transform, sensor, image, self.cache_folder, camera_index)
+                camera = Camera(transform, sensor, image, self.cache_folder, camera_index, fetch=self.download_image)
                 self.cameras.append(camera)
                 camera_index += 1
 
@@ -150,7 +249,7 @@ class Scene(object):
 
     def get_area_annotations(self):
         url = f'https://{config.PREFIX}.dronedeploy.com/api/v2/annotations?plan_id={self.plan_id}&embed=graph'
-        response = requests.get(url, headers=self.headers)
+        response = client.get(url, headers=self.headers)
         for geometry in response.json():
             if geometry['annotation_type'] == 'AREA':
                 # if geometry['color'] == '#fe9700':
@@ -158,14 +257,14 @@ class Scene(object):
 
     def delete_area_annotation(self):
         url = f'https://{config.PREFIX}.dronedeploy.com/api/v2/annotations?plan_id={self.plan_id}&embed=graph'
-        response = requests.get(url, headers=self.headers)
+        response = client.get(url, headers=self.headers)
         for geometry in response.json():
             if geometry['annotation_type'] != 'AREA': 
                 continue
             # print(geometry['id'])
             url = f'https://{config.PREFIX}.dronedeploy.com/api/v2/annotations/{geometry["id"]}'
             # print(url)
-            response = requests.delete(url, headers=self.headers)
+            response = client.delete(url, headers=self.headers)
 
     def enu_areas(self):
             ret = []
@@ -178,25 +277,20 @@ class Scene(object):
                 ret.append((x, y)) 
             return ret
 
-    def create_area_annotation_latlngs(self, geometry):
+    def post_annotation(self, annotation_type, geometry):
         url = f'https://{config.PREFIX}.dronedeploy.com/api/v2/annotations/'
-        data = {
-            "annotation_type":"AREA",
-            "color":"#00ff00",
-            "color_locked":False,
-            "comments":[],
-            "content":[],
-            "deleted":False,
-            "description":"AI Created Area",
-            "fill_color":"#00ff00",
-            "geometry":geometry,
-            "plan_id": f"{self.plan_id}",
-            "type":"markergroup",
-            "measurements_3d":[]
-        }
+        data = annotation_payload(self.plan_id, annotation_type, geometry)
+        response = client.post(url, headers=self.headers,  data=json.dumps(data))
+        return response.json()
+
+    def create_annotations(self, geometries, annotation_type="AREA", workers=None):
+        writer = AnnotationWriter(self.plan_id, self.headers, workers=workers)
+        result = writer.create(geometries, annotation_type)
+        print(result)
+        return result
 
-        response = requests.post(url, headers=self.headers,  data=json.dumps(data))
-        response = response.json()
+    def create_area_annotation_latlngs(self, geometry):
+        response = self.post_annotation("AREA", geometry)
         print(response)
 
     def create_area_annotation_ortho(self, xys):
@@ -209,123 +303,93 @@ class Scene(object):
             lat = self.bounds[1] + (self.bounds[3]-self.bounds[1]) * (1.0 - xy[1] / self.ortho_height)
             geometry.append(dict(lat=lat, lng=lng))
         
-        url = f'https://{config.PREFIX}.dronedeploy.com/api/v2/annotations/'
-        data = {
-            "annotation_type":"AREA",
-            "color":"#00ff00",
-            "color_locked":False,
-            "comments":[],
-            "content":[],
-            "deleted":False,
-            "description":"AI Created Area",
-            "fill_color":"#00ff00",
-            "geometry":geometry,
-            "plan_id": f"{self.plan_id}",
-            "type":"markergroup",
-            "measurements_3d":[]
-        }
-
-        response = requests.post(url, headers=self.headers,  data=json.dumps(data))
-        response = response.json()
+        response = self.post_annotation("AREA", geometry)
         print(response)
     
     def create_count_annotations_latlngs(self, geometry):
-        url = f'https://{config.PREFIX}.dronedeploy.com/api/v2/annotations/'
-        data = {
-            "annotation_type":"COUNT",
-            "color": "#f39c12",
-            "color_locked":False,
-            "comments":[],
-            "content":[],
-            "deleted":False,
-            "description":"AI Count",
-            "fill_color": "#e67e22",
-            "geometry":geometry,
-            "plan_id": f"{self.plan_id}",
-            "type":"polygon",
-            "measurements_3d":[]
-        }
-
-        response = requests.post(url, headers=self.headers,  data=json.dumps(data))
-        response = response.json()
+        response = self.post_annotation("COUNT", geometry)
 
     def create_count_annotations(self, camera, xys, _pixel_buffer=15):
 
-        geometry = []
-        for xy in xys:
-            enu = self.pointcloud.ray_cast(camera, xy)
-            lla = enu2lla(enu, self.transform.R, self.transform.S, self.transform.T)
-            lng, lat, alt = lla[0]
-            geometry.append(dict(lat=lat, lng=lng))
+        enu = self.pointcloud.ray_cast_many(camera, xys)
+        lla = enu2lla(enu, self.transform.R, self.transform.S, self.transform.T)
+        geometry = [dict(lat=lat, lng=lng) for lng, lat, alt in lla]
 
-        url = f'https://{config.PREFIX}.dronedeploy.com/api/v2/annotations/'
-        data = {
-            "annotation_type":"COUNT",
-            "color": "#f39c12",
-            "color_locked":False,
-            "comments":[],
-            "content":[],
-            "deleted":False,
-            "description":"AI Count",
-            "fill_color": "#e67e22",
-            "geometry":geometry,
-            "plan_id": f"{self.plan_id}",
-            "type":"polygon",
-            "measurements_3d":[]
-        }
-
-        response = requests.post(url, headers=self.headers,  data=json.dumps(data))
-        response = response.json()
+        response = self.post_annotation("COUNT", geometry)
 
     def download_signed_url(self, signed_url, filename, ignore_404=False, guess_ext=False) -> str:
 
         local = f'{self.cache_folder}/{filename}'
-        if os.path.exists(local):
-            # print("CACHE HIR")
+        if self.cached(filename):
             return local
         else:
+            self.cache.miss(local)
             print("downloading", filename)
-            r = requests.get(signed_url)
-            if ignore_404:
-                assert r.status_code in (200, 404)
-            else:
-                assert r.status_code == 200
-            if r.status_code == 200:
-                if guess_ext:
-                    if r.headers["Content-Type"] == "image/jpeg":
-                        ext = ".jpg"
-                    elif r.headers["Content-Type"] == "image/png":
-                        ext = ".png"
-                    else:
-                        raise("Unknown content-type: " + r.headers["Content-Type"])
-                    local_with_ext = local + ext
-                else:
-                    local_with_ext = local
-                open(local_with_ext, "wb").write(r.content)
-            elif r.status_code == 404 and ignore_404:
+            local_with_ext = stream_to_file(signed_url, local, ignore_404=ignore_404, guess_ext=guess_ext)
+            if not local_with_ext:
                 return ""
-        
-        if '.zip' in local_with_ext:
-            print("Unzipping", local_with_ext)
-            os.system(f'unzip {local_with_ext} -d {self.cache_folder}')
 
         return local_with_ext
 
-    def download_export(self, plan_json, export_filename) -> str:
+    def download_export(self, plan_json, export_filename, members=None) -> str:
         cache = f'{self.cache_folder}/{export_filename}'
-        if os.path.exists(cache):
-            return cache
-        signed_url = next( e["url"] for e in plan_json["exports"] if export_filename in e["url"] )
-        return self.download_signed_url(signed_url, export_filename)
+        # name -> size of the members last extracted, so an evicted zip is only
+        # fetched again when one of its extracted files is gone as well
+        record = f'{cache}.members.json'
+        if os.path.exists(record):
+            extracted = json.load(open(record))
+            if all(os.path.exists(f'{self.cache_folder}/{name}') and os.path.getsize(f'{self.cache_folder}/{name}') == size
+                   for name, size in extracted.items()):
+                return cache
+
+        if not self.cached(export_filename):
+            signed_url = next( e["url"] for e in plan_json["exports"] if export_filename in e["url"] )
+            cache = self.download_signed_url(signed_url, export_filename)
+
+        if cache.endswith('.zip'):
+            paths = extract_members(cache, str(self.cache_folder), members)
+            extracted = {os.path.relpath(path, self.cache_folder): os.path.getsize(path) for path in paths}
+            write_atomic(record, json.dumps(extracted, indent=2).encode())
+
+        return cache
+
+    def drop_stale_exports(self, previous, plan):
+        # a reprocessed plan links new exports, the signature in the query changes on every fetch
+        paths = lambda plan: {e["url"].split('?')[0] for e in plan.get("exports") or []}
+        for url in paths(previous) - paths(plan):
+            self.drop_export(os.path.basename(url))
+
+    def drop_export(self, export_filename):
+        # the export, its members record and whatever was extracted or converted from it
+        cache = f'{self.cache_folder}/{export_filename}'
+        record = f'{cache}.members.json'
+        members = json.load(open(record)) if os.path.exists(record) else {}
+        for name in members:
+            local = f'{self.cache_folder}/{name}'
+            if local.endswith('.las'):
+                remove_cache(local.replace('.las', '.npy'))
+            if os.path.exists(local):
+                os.remove(local)
+        for local in (cache, record):
+            if os.path.exists(local):
+                os.remove(local)
+        print("dropped stale", export_filename)
 
     def download_pointcloud(self):
-        self.download_export(self.plan, "points.zip"),
         pointcloud = self.cache_folder / 'points.las'
-        self.pointcloud = PointCloud(pointcloud, self.transform)
+        # the compact ENU cache is enough, the export is only needed to rebuild it
+        xyzfile, rgbfile = compact_paths(str(pointcloud).replace('.las', '.npy'))
+        if PointCloud.is_cached(pointcloud, self.transform):
+            self.cache.hit(xyzfile)
+            self.cache.hit(rgbfile)
+        else:
+            self.cache.miss(xyzfile)
+            self.download_export(self.plan, "points.zip", members=lambda name: os.path.basename(name) == 'points.las')
+        self._pointcloud = PointCloud(pointcloud, self.transform, cache=self.cache)
         
     def download_mesh(self):
-        self.download_export(self.plan, "model.zip"),
+        self.download_export(self.plan, "model.zip", members=lambda name: Path(name).suffix.lower() in MESH_SUFFIXES)
         meshfile = self.cache_folder / 'scene_mesh_textured.obj'
-        self.mesh = Mesh(str(meshfile))
+        self._mesh = Mesh(str(meshfile))
     
     
\ No newline at end of file
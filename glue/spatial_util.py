@@ -0,0 +1,207 @@
+import numpy as np
+import os
+
+from .config import config
+from .cache_util import part_path
+
+def points_in_polygon(px, py, vx, vy):
+    # points exactly on an edge may fall either way
+    return points_in_rings(px, py, [(vx, vy)])
+
+def points_in_rings(px, py, rings):
+    # even-odd over all rings, each edge only tests the y sorted run it spans
+    px = np.asarray(px, dtype=np.float64)
+    py = np.asarray(py, dtype=np.float64)
+    order = np.argsort(py.ravel(), kind='stable')
+    sx, sy = px.ravel()[order], py.ravel()[order]
+    inside = np.zeros(len(order), dtype=bool)
+
+    for vx, vy in rings:
+        ax = np.asarray(vx, dtype=np.float64)
+        ay = np.asarray(vy, dtype=np.float64)
+        bx, by = np.roll(ax, -1), np.roll(ay, -1)
+        edges = ay != by
+        ax, ay, bx, by = ax[edges], ay[edges], bx[edges], by[edges]
+        begins = np.searchsorted(sy, np.minimum(ay, by))
+        ends = np.searchsorted(sy, np.maximum(ay, by))
+        for begin, end, x0, y0, x1, y1 in zip(begins, ends, ax, ay, bx, by):
+            xs = x0 + (sy[begin:end] - y0) * (x1 - x0) / (y1 - y0)
+            inside[begin:end] ^= sx[begin:end] < xs
+
+    ret = np.empty(len(order), dtype=bool)
+    ret[order] = inside
+    return ret.reshape(px.shape)
+
+def _is_coordinates(values):
+    try:
+        return np.asarray(values, dtype=np.float64).ndim == 1
+    except (ValueError, TypeError):
+        return False
+
+def polygon_rings(polygon):
+    # accepts (x, y), nested shell/hole/part lists or shapely geometries
+    if hasattr(polygon, 'geoms'):
+        return [ring for part in polygon.geoms for ring in polygon_rings(part)]
+    if hasattr(polygon, 'exterior'):
+        return [tuple(np.asarray(ring.coords.xy)) for ring in [polygon.exterior, *polygon.interiors]]
+    if len(polygon) == 2 and _is_coordinates(polygon[0]):
+        return [(polygon[0], polygon[1])]
+    return [ring for part in polygon for ring in polygon_rings(part)]
+
+def footprint_bbox(camera, border, zrange):
+    # None when the view cone reaches the horizon
+    rays = camera.rays(border)
+    position = np.asarray(camera.position, dtype=np.float64)
+    zmin, zmax = zrange
+
+    if position[2] > zmax and not np.all(rays[:, 2] < 0):
+        return None
+    if position[2] < zmin and not np.all(rays[:, 2] > 0):
+        return None
+    if zmin <= position[2] <= zmax and np.any(rays[:, 2] == 0):
+        return None
+
+    footprint = [position[:2]] if zmin <= position[2] <= zmax else []
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for z in (zmin, zmax):
+            s = (z - position[2]) / rays[:, 2]
+            ahead = np.isfinite(s) & (s > 0)
+            footprint.extend(position[:2] + s[ahead, None] * rays[ahead, :2])
+
+    footprint = np.array(footprint)
+    lo, hi = footprint.min(axis=0), footprint.max(axis=0)
+    # the cone edges bend slightly under lens distortion
+    pad = 0.1 * (hi - lo).max() + 0.01
+    return lo[0] - pad, lo[1] - pad, hi[0] + pad, hi[1] + pad
+
+
+class GridIndex(object):
+    # points sorted by cell, a bbox query is one slice of order per grid row
+
+    def __init__(self, origin, cell_size, shape, order, starts, zrange):
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.cell_size = float(cell_size)
+        self.shape = tuple(int(n) for n in shape)
+        self.order = order
+        self.starts = starts
+        self.zrange = tuple(float(z) for z in zrange)
+
+    @classmethod
+    def build(cls, xyz, cell_size=None):
+        n = len(xyz)
+        lo = xyz[:, :2].min(axis=0).astype(np.float64) if n else np.zeros(2)
+        hi = xyz[:, :2].max(axis=0).astype(np.float64) if n else np.zeros(2)
+        zrange = (float(xyz[:, 2].min()), float(xyz[:, 2].max())) if n else (0.0, 0.0)
+
+        if cell_size is None:
+            area = max(float(np.prod(hi - lo)), 1e-6)
+            cell_size = np.sqrt(area * config.INDEX_POINTS_PER_CELL / max(n, 1))
+        cell_size = max(float(cell_size), 1e-6)
+
+        nx, ny = (np.floor((hi - lo) / cell_size).astype(np.int64) + 1)
+        cells = cls._cells(xyz, lo, cell_size, nx, ny)
+        order = np.argsort(cells, kind='stable').astype(np.int32 if n < 2**31 else np.int64)
+        starts = np.searchsorted(cells[order], np.arange(nx * ny + 1)).astype(order.dtype)
+        return cls(lo, cell_size, (nx, ny), order, starts, zrange)
+
+    @staticmethod
+    def _cells(xyz, origin, cell_size, nx, ny):
+        ix = np.clip(((xyz[:, 0] - origin[0]) / cell_size).astype(np.int64), 0, nx - 1)
+        iy = np.clip(((xyz[:, 1] - origin[1]) / cell_size).astype(np.int64), 0, ny - 1)
+        return iy * nx + ix
+
+    @property
+    def num_points(self):
+        return len(self.order)
+
+    @property
+    def bounds(self):
+        nx, ny = self.shape
+        return [
+            self.origin[0],
+            self.origin[1],
+            self.origin[0] + nx * self.cell_size,
+            self.origin[1] + ny * self.cell_size,
+        ]
+
+    def save(self, filename):
+        part = part_path(filename)
+        with open(part, 'wb') as f:
+            np.savez(f, origin=self.origin, cell_size=self.cell_size, shape=self.shape,
+                     order=self.order, starts=self.starts, zrange=self.zrange)
+        os.replace(part, filename)
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        return cls(data['origin'], data['cell_size'], data['shape'], data['order'], data['starts'], data['zrange'])
+
+    def candidates(self, xmin, ymin, xmax, ymax):
+        # a superset of the points inside the bbox
+        nx, ny = self.shape
+        ix0, iy0 = np.floor((np.array([xmin, ymin]) - self.origin) / self.cell_size).astype(np.int64)
+        ix1, iy1 = np.floor((np.array([xmax, ymax]) - self.origin) / self.cell_size).astype(np.int64)
+        if ix1 < 0 or iy1 < 0 or ix0 >= nx or iy0 >= ny:
+            return np.zeros(0, dtype=self.order.dtype)
+        ix0, iy0 = max(ix0, 0), max(iy0, 0)
+        ix1, iy1 = min(ix1, nx - 1), min(iy1, ny - 1)
+
+        rows = np.arange(iy0, iy1 + 1) * nx
+        begin = self.starts[rows + ix0]
+        end = self.starts[rows + ix1 + 1]
+        if len(rows) == 1:
+            return self.order[begin[0]:end[0]]
+        return np.concatenate([self.order[b:e] for b, e in zip(begin, end)])
+
+    def query_bbox(self, xyz, xmin, ymin, xmax, ymax):
+        index = self.candidates(xmin, ymin, xmax, ymax)
+        x, y = xyz[index, 0], xyz[index, 1]
+        return index[(x > xmin) & (x < xmax) & (y > ymin) & (y < ymax)]
+
+    def query_polygon(self, xyz, x, y):
+        x, y = np.asarray(x), np.asarray(y)
+        index = self.query_bbox(xyz, x.min(), y.min(), x.max(), y.max())
+        return index[points_in_polygon(xyz[index, 0], xyz[index, 1], x, y)]
+
+    def query_rings(self, xyz, rings):
+        vx = np.concatenate([np.asarray(x, dtype=np.float64) for x, _ in rings])
+        vy = np.concatenate([np.asarray(y, dtype=np.float64) for _, y in rings])
+        index = self.query_bbox(xyz, vx.min(), vy.min(), vx.max(), vy.max())
+        return index[points_in_rings(xyz[index, 0], xyz[index, 1], rings)]
+
+    def label_polygons(self, xyz, polygons):
+        # the first polygon containing a point wins
+        labels = np.full(len(xyz), -1, dtype=np.int32)
+        for label, polygon in enumerate(polygons):
+            index = self.query_rings(xyz, polygon_rings(polygon))
+            labels[index[labels[index] < 0]] = label
+        return labels
+
+    def query_radius(self, xyz, center, radius):
+        center = np.asarray(center, dtype=np.float64)
+        index = self.candidates(center[0] - radius, center[1] - radius, center[0] + radius, center[1] + radius)
+        distance = np.linalg.norm(xyz[index, :len(center)] - center, axis=1)
+        return index[distance <= radius]
+
+    def query_knn(self, xyz, center, k):
+        # nearest first
+        center = np.asarray(center, dtype=np.float64)
+        k = min(k, self.num_points)
+        if k == 0:
+            return np.zeros(0, dtype=self.order.dtype)
+
+        extent = self.cell_size * max(self.shape) * 2
+        radius = self.cell_size
+        while True:
+            index = self.candidates(center[0] - radius, center[1] - radius, center[0] + radius, center[1] + radius)
+            if len(index) >= k:
+                distance = np.linalg.norm(xyz[index, :len(center)] - center, axis=1)
+                nearest = np.argpartition(distance, k - 1)[:k]
+                kth = distance[nearest].max()
+                # the box only covers the disc of its own half width
+                if kth <= radius or radius > extent:
+                    nearest = nearest[np.argsort(distance[nearest], kind='stable')]
+                    return index[nearest]
+                radius = kth
+            else:
+                radius *= 2
@@ -0,0 +1,141 @@
+import numpy as np
+import os, json, shutil
+
+from .config import config
+from .spatial_util import footprint_bbox
+from .cache_util import part_path
+
+class TileSet(object):
+    # one xyz/rgb .npy pair per occupied tile plus an index.json
+
+    INDEX = 'index.json'
+
+    def __init__(self, folder, tile_size, origin, shape, zrange, tiles):
+        self.folder = str(folder)
+        self.tile_size = float(tile_size)
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.shape = tuple(int(n) for n in shape)
+        self.zrange = tuple(float(z) for z in zrange)
+        self.tiles = tiles
+
+    @classmethod
+    def exists(cls, folder):
+        # tiles are .npy files the cache manager may evict one at a time
+        if not os.path.exists(os.path.join(folder, cls.INDEX)):
+            return False
+        return all(
+            os.path.exists(os.path.join(folder, f"{tile['name']}.{kind}.npy"))
+            for tile in cls.load(folder).tiles for kind in ('xyz', 'rgb')
+        )
+
+    @classmethod
+    def load(cls, folder):
+        index = json.load(open(os.path.join(folder, cls.INDEX)))
+        return cls(folder, index['tile_size'], index['origin'], index['shape'], index['zrange'], index['tiles'])
+
+    @classmethod
+    def write(cls, xyz, rgb, folder, tile_size=None, chunk_size=None):
+        tile_size = float(tile_size or config.TILE_SIZE)
+        chunk_size = chunk_size or config.POINTCLOUD_CHUNK_SIZE
+        n = len(xyz)
+        chunks = range(0, n, chunk_size)
+
+        lo, hi = np.full(3, np.inf), np.full(3, -np.inf)
+        for start in chunks:
+            chunk = np.asarray(xyz[start:start + chunk_size], dtype=np.float64)
+            lo = np.minimum(lo, chunk.min(axis=0))
+            hi = np.maximum(hi, chunk.max(axis=0))
+        if n == 0:
+            lo, hi = np.zeros(3), np.zeros(3)
+
+        origin = lo[:2]
+        nx, ny = (np.floor((hi[:2] - origin) / tile_size).astype(np.int64) + 1)
+
+        def tiles_of(chunk):
+            ix = np.clip(((chunk[:, 0] - origin[0]) / tile_size).astype(np.int64), 0, nx - 1)
+            iy = np.clip(((chunk[:, 1] - origin[1]) / tile_size).astype(np.int64), 0, ny - 1)
+            return iy * nx + ix
+
+        counts = np.zeros(nx * ny, dtype=np.int64)
+        for start in chunks:
+            counts += np.bincount(tiles_of(xyz[start:start + chunk_size]), minlength=nx * ny)
+
+        part = part_path(folder)
+        shutil.rmtree(part, ignore_errors=True)
+        os.makedirs(part)
+
+        # each tile is a .npy header followed by its rows appended in chunk
+        # order, with only one file open at a time however many tiles there are
+        tiles, paths = [], {}
+        for tile in np.nonzero(counts)[0]:
+            iy, ix = divmod(int(tile), int(nx))
+            name = f'{ix}_{iy}'
+            count = int(counts[tile])
+            paths[tile] = (os.path.join(part, f'{name}.xyz.npy'), os.path.join(part, f'{name}.rgb.npy'))
+            for path, dtype in zip(paths[tile], (np.float32, np.uint8)):
+                with open(path, 'wb') as f:
+                    header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': (count, 3)}
+                    np.lib.format.write_array_header_1_0(f, header)
+            x0, y0 = origin + [ix * tile_size, iy * tile_size]
+            tiles.append({
+                'name': name,
+                'count': count,
+                'bounds': [float(x0), float(y0), float(x0 + tile_size), float(y0 + tile_size)],
+            })
+
+        for start in chunks:
+            chunk_xyz = np.asarray(xyz[start:start + chunk_size], dtype=np.float32)
+            chunk_rgb = np.asarray(rgb[start:start + chunk_size], dtype=np.uint8)
+            ids = tiles_of(chunk_xyz)
+            order = np.argsort(ids, kind='stable')
+            chunk_xyz, chunk_rgb, ids = chunk_xyz[order], chunk_rgb[order], ids[order]
+            present, begins = np.unique(ids, return_index=True)
+            ends = np.append(begins[1:], len(ids))
+            for tile, begin, end in zip(present, begins, ends):
+                for path, rows in zip(paths[tile], (chunk_xyz[begin:end], chunk_rgb[begin:end])):
+                    with open(path, 'ab') as f:
+                        f.write(rows.tobytes())
+
+        index = {
+            'tile_size': tile_size,
+            'origin': origin.tolist(),
+            'shape': [int(nx), int(ny)],
+            'zrange': [float(lo[2]), float(hi[2])],
+            'num_points': int(n),
+            'tiles': tiles,
+        }
+        json.dump(index, open(os.path.join(part, cls.INDEX), 'w'), indent=2)
+        shutil.rmtree(folder, ignore_errors=True)
+        os.replace(part, folder)
+        print(f"saved {len(tiles)} tiles to {folder}")
+        return cls(folder, tile_size, origin, (nx, ny), index['zrange'], tiles)
+
+    @property
+    def num_points(self):
+        return sum(tile['count'] for tile in self.tiles)
+
+    def select_bbox(self, xmin, ymin, xmax, ymax):
+        return [
+            tile for tile in self.tiles
+            if tile['bounds'][0] <= xmax and tile['bounds'][2] >= xmin
+            and tile['bounds'][1] <= ymax and tile['bounds'][3] >= ymin
+        ]
+
+    def select_polygon(self, x, y):
+        x, y = np.asarray(x), np.asarray(y)
+        return self.select_bbox(x.min(), y.min(), x.max(), y.max())
+
+    def select_frustum(self, camera, margin=0):
+        # every tile when the view reaches the horizon
+        bbox = footprint_bbox(camera, camera.border(margin), self.zrange)
+        return list(self.tiles) if bbox is None else self.select_bbox(*bbox)
+
+    def read(self, tiles):
+        if not tiles:
+            return np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.uint8)
+        xyz = np.concatenate([np.load(os.path.join(self.folder, f"{tile['name']}.xyz.npy"), mmap_mode='r') for tile in tiles])
+        rgb = np.concatenate([np.load(os.path.join(self.folder, f"{tile['name']}.rgb.npy"), mmap_mode='r') for tile in tiles])
+        return xyz, rgb
+
+    def __repr__(self):
+        return f'{len(self.tiles)} tiles of {self.tile_size:g}m, {self.num_points} points'
@@ -0,0 +1,62 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from .config import config
+
+def mask_hits(mask, pixels):
+    # uint8 masks count 255 as foreground
+    mask = np.asarray(mask)
+    return mask[pixels[:, 1], pixels[:, 0]] if mask.dtype == bool else mask[pixels[:, 1], pixels[:, 0]] == 255
+
+
+class MaskVotes(object):
+    def __init__(self, num_points):
+        self.vote = np.zeros(num_points, dtype=np.uint32)
+        self.total = np.zeros(num_points, dtype=np.uint32)
+
+    @property
+    def num_points(self):
+        return len(self.total)
+
+    @staticmethod
+    def observe(pointcloud, camera, mask):
+        mask = np.asarray(mask)
+        # one pixel of margin keeps the points that round onto the border
+        projected, visible = pointcloud.project_visible(camera, margin=1)
+        H, W = mask.shape[:2]
+        scale = np.array([W / camera.width, H / camera.height])
+        pixels = np.floor(0.5 + projected * scale).astype(np.int64)
+        inside = (pixels[:, 0] >= 0) & (pixels[:, 0] < W) & (pixels[:, 1] >= 0) & (pixels[:, 1] < H)
+        visible, pixels = visible[inside], pixels[inside]
+        return visible, mask_hits(mask, pixels)
+
+    def add(self, pointcloud, pairs, workers=None):
+        pairs = list(pairs)
+        workers = workers or config.VOTE_WORKERS
+        observe = lambda pair: self.observe(pointcloud, *pair)
+        if len(pairs) <= 1 or workers <= 1:
+            observations = [observe(pair) for pair in pairs]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                observations = list(pool.map(observe, pairs))
+
+        if not observations:
+            return self
+        visible = np.concatenate([visible for visible, _ in observations])
+        hits = np.concatenate([hits for _, hits in observations])
+        self.total += np.bincount(visible, minlength=self.num_points).astype(self.total.dtype)
+        self.vote += np.bincount(visible[hits], minlength=self.num_points).astype(self.vote.dtype)
+        return self
+
+    def agreement(self):
+        return np.divide(self.vote, self.total, out=np.zeros(self.num_points), where=self.total > 0)
+
+    def keep_mask(self, threshold=None):
+        threshold = config.VOTE_THRESHOLD if threshold is None else threshold
+        return (self.total > 0) & (self.agreement() > threshold)
+
+    def keep_index(self, threshold=None):
+        return np.where(self.keep_mask(threshold))[0]
+
+    def __repr__(self):
+        return f'mask votes over {self.num_points} points, {np.count_nonzero(self.total)} seen'
@@ -0,0 +1,35 @@
+import json
+import requests
+
+class FakeResponse:
+    # stands in for requests.Response in the client mocks
+
+    def __init__(self, body=b'', status_code=200, headers=None):
+        self.body = body
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def content(self):
+        return self.body if isinstance(self.body, bytes) else json.dumps(self.body).encode()
+
+    def json(self):
+        return json.loads(self.body) if isinstance(self.body, bytes) else self.body
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError(self.json().get('message'))
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
@@ -0,0 +1,31 @@
+import sys
+import os
+cwd = os.getcwd()
+sys.path.append(cwd)
+
+import json
+from glue.annotation_util import AnnotationWriter, annotation_payload
+from tests.conftest import FakeResponse
+
+def test_annotation_payload():
+    geometry = [dict(lat=1.0, lng=2.0)]
+    data = annotation_payload('plan', 'COUNT', geometry)
+    assert data['annotation_type'] == 'COUNT'
+    assert data['type'] == 'polygon'
+    assert data['geometry'] == geometry
+    assert data['plan_id'] == 'plan'
+
+def test_annotation_writer_collects_ids_and_failures(mocker):
+
+    def post(url, headers=None, data=None):
+        lat = json.loads(data)['geometry'][0]['lat']
+        if lat == 1:
+            return FakeResponse({'message': 'bad geometry'}, status_code=400)
+        return FakeResponse({'id': f'annotation-{lat}'})
+
+    mocker.patch('glue.annotation_util.client.post', side_effect=post)
+    geometries = [[dict(lat=lat, lng=0)] for lat in range(4)]
+    result = AnnotationWriter('plan', {}, workers=2).create(geometries, 'AREA')
+
+    assert result.ids == ['annotation-0', None, 'annotation-2', 'annotation-3']
+    assert result.failures == [(1, 'bad geometry')]
@@ -0,0 +1,39 @@
+import sys
+import os
+cwd = os.getcwd()
+sys.path.append(cwd)
+
+import asyncio
+import pytest
+# glue.scene pulls in the mesh module, which needs open3d
+pytest.importorskip('open3d')
+from glue.async_scene import AsyncScene
+from glue.issue_utils import Issue
+from tests.test_scene import fake_plan_server
+
+def test_concurrent_calls_share_each_lazy_asset(tmp_path, mocker, monkeypatch):
+
+    monkeypatch.setenv('DRONEDEPLOY', 'token')
+    requested = fake_plan_server(mocker)
+    create = mocker.patch.object(Issue, 'create', return_value='Issue:1')
+
+    async def run():
+        async with await AsyncScene.open('plan', str(tmp_path)) as scene:
+            results = await asyncio.gather(
+                scene.download_pointcloud(),
+                scene.download_pointcloud(),
+                scene.create_issue(scene.cameras[0], [[10, 10]]),
+                scene.create_issue(scene.cameras[0], [[20, 20]]),
+                scene.download_images(),
+                scene.download_images(),
+            )
+            # a second pass finds everything cached
+            assert await scene.download_images() == []
+            return scene, results
+
+    scene, (first, second, *issues, images, _) = asyncio.run(run())
+    assert first is second is scene.scene.pointcloud and first.num_points == 10
+    assert issues == ['Issue:1', 'Issue:1'] and create.call_count == 2
+    assert requested.count('https://exports/points.zip') == 1
+    assert sorted(url.split('/')[-2] for url in requested if '/images/' in url) == ['a.jpg', 'b.jpg']
+    assert scene.scene.cache.hits >= 2
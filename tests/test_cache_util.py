@@ -0,0 +1,81 @@
+import sys
+import os
+cwd = os.getcwd()
+sys.path.append(cwd)
+
+import time
+from glue.cache_util import CacheManifest
+from tests.conftest import FakeResponse
+
+HEADERS = {'ETag': '"abc"', 'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+
+def test_manifest_freshness_and_validators(tmp_path):
+
+    (tmp_path / 'plan.json').write_text('{"id": 1}')
+    manifest = CacheManifest(tmp_path)
+    assert not manifest.fresh('plan.json')
+    assert manifest.validators('plan.json') == {}
+
+    assert manifest.record('plan.json', FakeResponse(headers=HEADERS))
+    assert manifest.fresh('plan.json', ttl=60)
+    assert manifest.validators('plan.json') == {
+        'If-None-Match': '"abc"',
+        'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT',
+    }
+
+    # reloaded from disk, and expired once the ttl has passed
+    manifest = CacheManifest(tmp_path)
+    manifest.entries['plan.json']['fetched_at'] = time.time() - 120
+    assert not manifest.fresh('plan.json', ttl=60)
+    assert manifest.fresh('plan.json', ttl=None)
+
+    # same content is not reported as a change, a truncated file is not fresh
+    assert not manifest.record('plan.json', FakeResponse(headers=HEADERS))
+    (tmp_path / 'plan.json').write_text('{')
+    assert not manifest.fresh('plan.json')
+
+def test_cache_manager_evicts_lru_and_spares_open_plans(tmp_path):
+    from glue.cache_util import CacheManager
+
+    for plan in ('a', 'b'):
+        (tmp_path / plan).mkdir()
+        for index, name in enumerate(('old.jpg', 'new.jpg', 'points.npy')):
+            local = tmp_path / plan / name
+            local.write_bytes(b'x' * 100)
+            os.utime(local, (1000 + index, 1000 + index))
+        (tmp_path / plan / 'plan.json').write_text('{}')
+
+    manager = CacheManager(tmp_path, budget=350)
+    manager.open('b')
+    assert manager.is_open('b')
+
+    removed = manager.evict()
+    assert sorted(path.name for path in removed) == ['new.jpg', 'old.jpg', 'points.npy']
+    assert all(path.parent.name == 'a' for path in removed)
+    assert (tmp_path / 'a' / 'plan.json').exists()
+
+    manager.close('b')
+    assert not manager.is_open('b')
+    manager.hit(tmp_path / 'b' / 'old.jpg')
+    manager.budget = 250
+    removed = manager.evict()
+    assert [path.name for path in removed] == ['new.jpg']
+    assert manager.hits == 1
+
+def test_plan_stays_open_until_every_scene_closed_it(tmp_path):
+    from glue.cache_util import CacheManager
+
+    (tmp_path / 'a').mkdir()
+    first, second = CacheManager(tmp_path), CacheManager(tmp_path)
+    first.open('a')
+    second.open('a')
+    first.close('a')
+    assert second.is_open('a')
+    second.close('a')
+    assert not second.is_open('a')
+    # closing again does not underflow the count
+    second.close('a')
+    first.open('a')
+    assert first.is_open('a')
+    first.close('a')
+    assert not first.is_open('a')
@@ -0,0 +1,114 @@
+import sys
+import os
+cwd = os.getcwd()
+sys.path.append(cwd)
+
+from glue.download_util import download_concurrently
+from tests.conftest import FakeResponse
+
+def test_download_concurrently_skips_cached(tmp_path):
+
+    (tmp_path / 'a.jpg').write_bytes(b'cached')
+    fetched = []
+
+    def download(name):
+        fetched.append(name)
+        local = tmp_path / name
+        local.write_bytes(b'x' * 10)
+        return str(local)
+
+    cached = lambda name: (tmp_path / name).exists()
+    stats = download_concurrently(['a.jpg', 'b.jpg', 'c.jpg'], download, cached, workers=2)
+
+    assert sorted(fetched) == ['b.jpg', 'c.jpg']
+    assert stats.skipped == 1
+    assert stats.done == 2
+    assert stats.bytes == 20
+
+def test_stream_to_file_resumes_partial(tmp_path, mocker):
+    import base64, hashlib
+    from glue.download_util import stream_to_file
+
+    body = b'0123456789' * 100
+    md5 = base64.b64encode(hashlib.md5(body).digest()).decode()
+    local = str(tmp_path / 'points.zip')
+    open(local + '.part', 'wb').write(body[:300])
+
+    def get(url, headers=None, stream=False):
+        assert headers == {'Range': 'bytes=300-'}
+        return FakeResponse(body[300:], 206, {
+            'Content-Range': f'bytes 300-{len(body) - 1}/{len(body)}',
+            'x-goog-hash': f'crc32c=AAAAAA==,md5={md5}',
+        })
+
+    mocker.patch('glue.download_util.client.get', side_effect=get)
+    assert stream_to_file('https://signed', local, chunk_size=64) == local
+    assert open(local, 'rb').read() == body
+    assert not os.path.exists(local + '.part')
+
+def test_stream_to_file_rejects_truncated(tmp_path, mocker):
+    import pytest
+    from glue.download_util import stream_to_file
+
+    local = str(tmp_path / 'model.zip')
+    response = FakeResponse(b'abc', headers={'Content-Length': '10'})
+    mocker.patch('glue.download_util.client.get', return_value=response)
+
+    with pytest.raises(IOError):
+        stream_to_file('https://signed', local, attempts=1)
+    assert not os.path.exists(local)
+
+def test_extract_members_selects_and_skips(tmp_path):
+    import zipfile
+    from glue.download_util import extract_members
+
+    archive = str(tmp_path / 'model.zip')
+    with zipfile.ZipFile(archive, 'w') as zf:
+        zf.writestr('scene_mesh_textured.obj', b'v 0 0 0\n')
+        zf.writestr('scene_mesh_textured.mtl', b'newmtl a\n')
+        zf.writestr('scene_mesh.ply', b'ply\n')
+
+    select = lambda name: not name.endswith('.ply')
+    locals = extract_members(archive, str(tmp_path), select, workers=2)
+    assert sorted(os.path.basename(local) for local in locals) == ['scene_mesh_textured.mtl', 'scene_mesh_textured.obj']
+    assert not (tmp_path / 'scene_mesh.ply').exists()
+
+    # a second pass leaves members already on disk alone
+    mtime = os.path.getmtime(tmp_path / 'scene_mesh_textured.obj')
+    os.utime(tmp_path / 'scene_mesh_textured.obj', (mtime - 100, mtime - 100))
+    extract_members(archive, str(tmp_path), select)
+    assert os.path.getmtime(tmp_path / 'scene_mesh_textured.obj') == mtime - 100
+
+def test_stream_to_file_has_one_writer_per_file(tmp_path, mocker):
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from glue.download_util import stream_to_file
+
+    body = b'0123456789' * 100
+    def get(url, headers=None, stream=False):
+        time.sleep(0.05)
+        return FakeResponse(body, headers={'Content-Length': str(len(body))})
+
+    fetch = mocker.patch('glue.download_util.client.get', side_effect=get)
+    local = str(tmp_path / 'points.zip')
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(lambda _: stream_to_file('https://signed', local, chunk_size=64), range(4)))
+
+    assert results == [local] * 4 and fetch.call_count == 1
+    assert open(local, 'rb').read() == body
+    assert os.listdir(tmp_path) == ['points.zip']
+
+def test_stream_to_file_ignores_content_md5_of_a_range(tmp_path, mocker):
+    import base64, hashlib
+    from glue.download_util import stream_to_file
+
+    body = b'0123456789' * 100
+    local = str(tmp_path / 'points.zip')
+    open(local + '.part', 'wb').write(body[:300])
+    # the md5 of the bytes sent, not of the whole file
+    md5 = base64.b64encode(hashlib.md5(body[300:]).digest()).decode()
+    response = FakeResponse(body[300:], 206, {'Content-Range': f'bytes 300-{len(body) - 1}/{len(body)}', 'Content-MD5': md5})
+    mocker.patch('glue.download_util.client.get', return_value=response)
+
+    assert stream_to_file('https://signed', local) == local
+    assert open(local, 'rb').read() == body
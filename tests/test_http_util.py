@@ -0,0 +1,45 @@
+import sys
+import os
+cwd = os.getcwd()
+sys.path.append(cwd)
+
+import pytest
+import requests
+from glue.http_util import HttpClient
+
+def test_http_client_records_stats(mocker):
+
+    client = HttpClient(pool_size=2, retries=0)
+    request = mocker.patch.object(client.session, 'request', return_value='response')
+
+    assert client.get('https://example.com', headers={}) == 'response'
+    assert client.post('https://example.com', data='{}') == 'response'
+    assert request.call_args.kwargs['timeout'] == client.timeout
+
+    request.side_effect = requests.ConnectionError()
+    with pytest.raises(requests.ConnectionError):
+        client.delete('https://example.com')
+
+    assert client.stats.count == 3
+    assert client.stats.errors == 1
+    assert client.stats.by_method == {'GET': 1, 'POST': 1, 'DELETE': 1}
+
+def test_configure_applies_to_the_shared_client(mocker):
+    from glue import http_util, plan_util
+    from glue.config import config
+
+    mocker.patch.object(config, 'HTTP_POOL_SIZE', 4)
+    mocker.patch.object(config, 'HTTP_TIMEOUT', (1, 2))
+    stats = http_util.client.stats
+    try:
+        assert http_util.configure(retries=0) is plan_util.client
+        assert plan_util.client.pool_size == 4 and plan_util.client.retries == 0
+        assert plan_util.client.session.get_adapter('https://example.com').max_retries.total == 0
+        assert plan_util.client.stats is stats
+
+        request = mocker.patch.object(plan_util.client.session, 'request', return_value='response')
+        assert plan_util.Api('plan', {}).request('plan') == 'response'
+        assert request.call_args.kwargs['timeout'] == (1, 2)
+    finally:
+        mocker.stopall()
+        http_util.configure()
@@ -0,0 +1,80 @@
+import sys
+import os
+cwd = os.getcwd()
+sys.path.append(cwd)
+
+import json
+import numpy as np
+from glue.issue_utils import Issue
+from glue.camera_util import Camera, Sensor
+from tests.conftest import FakeResponse
+
+class FakeTransform:
+    R = np.eye(3)
+    S = 1.0
+    T = np.array([4187814.29362, 828920.453163, 4723695.16181])
+
+def test_create_bulk_batches_aliased_mutations(mocker):
+
+    pointcloud = mocker.Mock()
+    pointcloud.ray_cast_many.side_effect = lambda camera, pixels: np.zeros((len(pixels), 3))
+    camera = Camera(np.eye(4), Sensor(W=100, H=100), 'image.jpg', '/tmp', 0)
+    issue = Issue('plan', 'folder', {}, pointcloud, FakeTransform())
+
+    queries = []
+    def post(url, headers=None, data=None):
+        query = json.loads(data)
+        queries.append(query)
+        names = sorted(query['variables'])
+        return FakeResponse({'data': {
+            name.replace('input', 'issue'): {'issue': {'id': f'Issue:{len(queries)}-{name}'}} for name in names
+        }})
+
+    mocker.patch('glue.issue_utils.client.post', side_effect=post)
+    ids = issue.create_bulk(camera, [[10, 10]] * 5, batch_size=2, workers=1)
+
+    assert len(queries) == 3
+    assert 'FullIssue' not in queries[0]['query']
+    assert 'issue1: createIssue(input: $input1) { issue { id } }' in queries[0]['query']
+    assert ids == ['Issue:1-input0', 'Issue:1-input1', 'Issue:2-input0', 'Issue:2-input1', 'Issue:3-input0']
+
+def test_create_bulk_skips_pixels_without_a_hit(mocker):
+
+    pointcloud = mocker.Mock()
+    pointcloud.ray_cast_many.side_effect = lambda camera, pixels: np.array([[0.0, 0.0, 0.0], [np.nan] * 3, [1.0, 1.0, 0.0]])
+    camera = Camera(np.eye(4), Sensor(W=100, H=100), 'image.jpg', '/tmp', 0)
+    issue = Issue('plan', 'folder', {}, pointcloud, FakeTransform())
+
+    def post(url, headers=None, data=None):
+        query = json.loads(data)
+        return FakeResponse({'data': {
+            name.replace('input', 'issue'): {'issue': {'id': f"Issue:{variables['location']['lat']:.6f}"}}
+            for name, variables in query['variables'].items()
+        }})
+
+    mocker.patch('glue.issue_utils.client.post', side_effect=post)
+    ids = issue.create_bulk(camera, [[10, 10], [50, 50], [90, 90]], batch_size=3, workers=1)
+    assert ids[0] is not None and ids[1] is None and ids[2] is not None and ids[0] != ids[2]
+
+def test_list_follows_cursor(mocker):
+    import pytest
+
+    node = lambda id, plan: {'node': {'id': id, 'initialPlan': {'id': f'Plan:{plan}'}}}
+    pages = {
+        '': {'edges': [node('Issue:1', 'plan'), node('Issue:2', 'other')], 'pageInfo': {'hasNextPage': True, 'endCursor': 'a'}},
+        'a': {'edges': [node('Issue:3', 'plan')], 'pageInfo': {'hasNextPage': False, 'endCursor': 'b'}},
+    }
+    def post(url, headers=None, data=None):
+        variables = json.loads(data)['variables']
+        assert variables['first'] == 2 and 'filter' not in variables
+        return FakeResponse({'data': {'project': {'issues': pages[variables['cursor']]}}})
+
+    mocker.patch('glue.issue_utils.client.post', side_effect=post)
+    issue = Issue('plan', 'folder', {}, None, FakeTransform())
+    assert list(issue.list(page_size=2)) == ['Issue:1', 'Issue:2', 'Issue:3']
+    assert list(issue.list(page_size=2, initial_plan='plan')) == ['Issue:1', 'Issue:3']
+
+    errors = [{'message': 'Cannot query field "issues"'}]
+    mocker.patch('glue.issue_utils.client.post', return_value=FakeResponse({'errors': errors, 'data': None}))
+    with pytest.raises(RuntimeError, match='Cannot query field'):
+        list(issue.list())
@@ -0,0 +1,461 @@
+import sys
+import os
+cwd = os.getcwd()
+sys.path.append(cwd)
+
+import laspy
+import numpy as np
+from glue.pointcloud_utils import PointCloud, compact_paths
+from tests.test_conv_utils import llapoints, enupoints
+
+class FakeTransform:
+    T = np.array([4187814.29362, 828920.453163, 4723695.16181])
+    Rinv = np.array([
+        [-0.19416918,  0.98096806,  0.        ],
+        [-0.72998009, -0.14448956,  0.66802084],
+        [ 0.6553071 ,  0.12970906,  0.74414257],
+    ])
+    Sinv = 1.0
+
+def write_las(filename, lla, colors):
+    header = laspy.LasHeader(point_format=2, version="1.2")
+    header.scales = np.array([1e-9, 1e-9, 1e-4])
+    header.offsets = lla.min(axis=0)
+    las = laspy.LasData(header)
+    las.x, las.y, las.z = lla[:, 0], lla[:, 1], lla[:, 2]
+    las.red, las.green, las.blue = (colors * 256).astype(np.uint16).T
+    las.write(filename)
+
+def test_las2numpy_writes_compact_memmapped_cache(tmp_path):
+
+    las = str(tmp_path / 'points.las')
+    write_las(las, llapoints[:, :3], llapoints[:, 3:])
+    cloud = PointCloud(las, FakeTransform())
+
+    xyzfile, rgbfile = compact_paths(tmp_path / 'points.npy')
+    assert os.path.exists(xyzfile) and os.path.exists(rgbfile)
+    assert isinstance(cloud.xyz, np.memmap)
+    assert cloud.xyz.dtype == np.float32 and cloud.rgb.dtype == np.uint8
+    assert np.allclose(cloud.xyz, enupoints[:, :3], atol=1e-3)
+    assert np.array_equal(cloud.rgb, enupoints[:, 3:].astype(np.uint8))
+    assert cloud.points.shape == (10, 6)
+
+    # reopening reads the cache without touching the LAS
+    os.remove(las)
+    assert PointCloud(las, FakeTransform()).num_points == 10
+
+def test_las2numpy_compacts_legacy_cache(tmp_path):
+
+    np.save(tmp_path / 'points.npy', enupoints)
+    cloud = PointCloud(str(tmp_path / 'points.las'), FakeTransform())
+    assert not (tmp_path / 'points.npy').exists()
+    assert np.allclose(cloud.xyz, enupoints[:, :3], atol=1e-5)
+
+def test_convert_las_in_parallel_chunks(tmp_path):
+
+    las = str(tmp_path / 'points.las')
+    lla = np.tile(llapoints[:, :3], (50, 1))
+    write_las(las, lla, np.tile(llapoints[:, 3:], (50, 1)))
+
+    xyzfile, rgbfile = compact_paths(tmp_path / 'points.npy')
+    cloud = PointCloud.from_arrays(np.zeros((0, 3)))
+    cloud.convert_las(FakeTransform.Rinv, FakeTransform.Sinv, FakeTransform.T, las, xyzfile, rgbfile, chunk_size=64, workers=2)
+
+    xyz = np.load(xyzfile)
+    assert xyz.shape == (500, 3)
+    assert np.allclose(xyz, np.tile(enupoints[:, :3], (50, 1)), atol=1e-3)
+    assert np.array_equal(np.load(rgbfile)[-10:], enupoints[:, 3:].astype(np.uint8))
+    assert not os.path.exists(f'{xyzfile}.part')
+
+def test_failed_conversion_cleans_up_pool_and_parts(tmp_path, mocker):
+    import multiprocessing
+    import pytest
+
+    las = str(tmp_path / 'points.las')
+    write_las(las, np.tile(llapoints[:, :3], (50, 1)), np.tile(llapoints[:, 3:], (50, 1)))
+    xyzfile, rgbfile = compact_paths(tmp_path / 'points.npy')
+    # a mock cannot be sent to the workers, so the chunks fail
+    mocker.patch('glue.pointcloud_utils.lla_to_enu_chunk', side_effect=ValueError('bad chunk'))
+
+    cloud = PointCloud.from_arrays(np.zeros((0, 3)))
+    with pytest.raises(Exception):
+        cloud.convert_las(FakeTransform.Rinv, FakeTransform.Sinv, FakeTransform.T, las, xyzfile, rgbfile, chunk_size=64, workers=2)
+    assert os.listdir(tmp_path) == ['points.las']
+    assert not multiprocessing.active_children()
+
+def nadir_camera(position, k1=0.0):
+    from glue.camera_util import Camera, Sensor
+    # looking straight down with image x along east and image y along south
+    R = np.diag([1.0, -1.0, -1.0])
+    pose = np.eye(4)
+    pose[:3, :3] = R
+    pose[:3, 3] = -R.dot(position)
+    sensor = Sensor(W=1000, H=800, fx=600, fy=600, cx=500, cy=400, k1=k1, k2=0, k3=0, k4=0, p1=0, p2=0)
+    return Camera(pose, sensor, 'image.jpg', '/tmp', 0)
+
+def random_cloud(n=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    xyz = rng.uniform([-60, -60, 0], [60, 60, 5], size=(n, 3))
+    rgb = rng.integers(0, 256, size=(n, 3))
+    return PointCloud.from_arrays(xyz, rgb)
+
+def test_crop_xy_uses_index_without_losing_points():
+
+    cloud = random_cloud()
+    camera = nadir_camera(np.array([5.0, -3.0, 60.0]), k1=-0.05)
+
+    projected = cloud.project(camera)
+    for xy in ([500, 400], [80, 90], [950, 700]):
+        window = (np.abs(projected[:, 0] - xy[0]) < 15) & (np.abs(projected[:, 1] - xy[1]) < 15)
+        candidates = cloud.cone_candidates(camera, xy, 15)
+        assert candidates is not None and len(candidates) < cloud.num_points / 10
+        assert np.array_equal(cloud.crop_xy(camera, xy, return_value=True), cloud.xyz[window])
+
+def test_ray_cast_many_matches_single_pixel_ray_cast():
+
+    cloud = random_cloud()
+    camera = nadir_camera(np.array([5.0, -3.0, 60.0]), k1=-0.05)
+    pixels = np.array([[500, 400], [80, 90], [950, 700], [512, 410], [-500, -500]])
+
+    hits = cloud.ray_cast_many(camera, pixels)
+    assert hits.shape == (5, 3)
+    for xy, hit in zip(pixels[:4], hits[:4]):
+        assert np.allclose(hit, cloud.ray_cast(camera, xy)[0])
+    assert np.all(np.isnan(hits[4]))
+
+def test_depth_buffer_returns_visible_surface(tmp_path):
+    from glue.depth_util import DepthBuffer
+
+    # a roof at z = 10 over a ground plane, the ground is hidden under the roof
+    rng = np.random.default_rng(1)
+    ground = np.hstack([rng.uniform(-30, 30, size=(40000, 2)), np.zeros((40000, 1))])
+    roof = np.hstack([rng.uniform(-5, 5, size=(4000, 2)), np.full((4000, 1), 10.0)])
+    cloud = PointCloud.from_arrays(np.vstack([ground, roof]))
+    cloud.source = str(tmp_path / 'points.npy')
+
+    camera = nadir_camera(np.array([0.0, 0.0, 60.0]))
+    camera.cache_folder = tmp_path
+
+    hits = cloud.ray_cast_many(camera, [[500, 400], [700, 200]], mode='depth')
+    assert np.allclose(hits[0, 2], 10.0)
+    assert np.allclose(hits[1, 2], 0.0)
+    assert np.allclose(hits[:, :2], [[0, 0], [20, 20]], atol=1.0)
+
+    filename = DepthBuffer.filename(camera, 0.25)
+    assert filename.exists()
+    assert DepthBuffer.load(filename).index.shape == (200, 250)
+
+def test_project_visible_culls_to_the_image_in_front_of_the_camera():
+
+    rng = np.random.default_rng(2)
+    cloud = PointCloud.from_arrays(rng.uniform([-200, -200, 0], [200, 200, 100], size=(50000, 3)))
+    # barrel distortion folds points far outside the view back into the image,
+    # keep the brute force reference free of those
+    camera = nadir_camera(np.array([10.0, 20.0, 60.0]), k1=0.05)
+
+    pixels, indices = cloud.project_visible(camera)
+
+    projected = cloud.project(camera)
+    depth = cloud.xyz.dot(camera.transform[2, :3]) + camera.transform[2, 3]
+    inside = (depth > 0) & np.all((projected >= 0) & (projected < [camera.width, camera.height]), axis=1)
+    assert np.array_equal(indices, np.where(inside)[0])
+    assert np.allclose(pixels, projected[inside])
+    assert len(indices) < cloud.num_points / 5
+
+def reference_project(camera, points):
+    # the original allocation heavy projection, kept to check the chunked kernel
+    from glue.pointcloud_utils import distort
+    p = np.hstack((points, np.ones((len(points), 1)))).T
+    x = np.asarray(camera.transform.dot(p).T)
+    x[:, 0] /= x[:, 2]
+    x[:, 1] /= x[:, 2]
+    return distort(x[:, :2], camera.K, camera.distortion)
+
+def test_chunked_projection_matches_reference():
+    from glue.camera_util import Sensor
+
+    cloud = random_cloud(50000)
+    camera = nadir_camera(np.array([5.0, -3.0, 60.0]))
+    camera.sensor = Sensor(W=1000, H=800, fx=610, fy=590, cx=505, cy=395,
+                           k1=-0.05, k2=0.01, k3=-0.002, k4=0.0005, p1=0.001, p2=-0.002)
+    expected = reference_project(camera, cloud.xyz)
+
+    assert np.allclose(cloud.project(camera), expected)
+    assert np.allclose(cloud.project(camera, chunk_size=4096, workers=4), expected)
+    projected = cloud.project(camera, dtype=np.float32, chunk_size=1000, workers=3)
+    assert projected.dtype == np.float32
+    assert np.allclose(projected, expected, atol=1e-2)
+
+def test_vote_masks_matches_per_point_loop():
+
+    cloud = random_cloud()
+    # pincushion distortion, see test_project_visible_culls_to_the_image_in_front_of_the_camera
+    cameras = [nadir_camera(np.array([x, 0.0, 60.0]), k1=0.05) for x in (-20.0, 0.0, 20.0)]
+    masks = []
+    for i, camera in enumerate(cameras):
+        mask = np.zeros((camera.height, camera.width), dtype=np.uint8)
+        mask[:, :camera.width // 2 + 100 * i] = 255
+        masks.append(mask)
+
+    vote = np.zeros(cloud.num_points)
+    total = np.zeros(cloud.num_points)
+    for camera, mask in zip(cameras, masks):
+        projected = np.floor(0.5 + cloud.project(camera)).astype(int)
+        for index, (x, y) in enumerate(projected):
+            if 0 <= x < camera.width and 0 <= y < camera.height:
+                vote[index] += mask[y, x] == 255
+                total[index] += 1
+
+    keep = cloud.vote_masks(zip(cameras, masks), workers=3)
+    assert np.array_equal(cloud.votes.total, total)
+    assert np.array_equal(cloud.votes.vote, vote)
+    with np.errstate(invalid='ignore'):
+        assert np.array_equal(keep, vote / total > 0.8)
+
+    cloud.crop_mask()
+    assert cloud.num_points == np.count_nonzero(keep)
+
+def test_views_crop_without_touching_the_base_cloud():
+
+    cloud = random_cloud()
+    camera = nadir_camera(np.array([5.0, -3.0, 60.0]), k1=0.05)
+    x, y = np.array([-30.0, 20.0, 0.0]), np.array([0.0, 10.0, 40.0])
+
+    view = cloud.view().crop_enu(x, y, approx=False).crop_xy(camera, [500, 400], 100)
+    assert cloud.num_points == 20000
+
+    legacy = random_cloud()
+    legacy.crop_enu(x, y, approx=False)
+    legacy.crop_xy(camera, [500, 400], 100)
+    assert 0 < view.num_points == legacy.num_points
+    assert np.array_equal(view.xyz, legacy.xyz)
+    assert np.array_equal(view.materialize().rgb, legacy.rgb)
+
+    pixels, indices = view.project_visible(camera)
+    assert np.allclose(pixels, view.project(camera)[indices])
+    assert len(indices) == view.num_points
+
+def test_view_from_matches_circles_drawn_far_to_near():
+    import cv2
+
+    cloud = random_cloud(3000)
+    camera = nadir_camera(np.array([5.0, -3.0, 60.0]), k1=0.05)
+
+    # painter's algorithm with the old per point cv2.circle calls
+    projected, visible = cloud.project_visible(camera, margin=3)
+    depth = cloud.xyz[visible].dot(camera.transform[2, :3]) + camera.transform[2, 3]
+    centres = np.floor(projected + 0.5).astype(int)
+    expected = np.zeros((camera.height, camera.width, 3), dtype=np.uint8)
+    for row in np.argsort(-depth):
+        color = cloud.rgb[visible[row]]
+        cv2.circle(expected, tuple(int(c) for c in centres[row]), 3, [int(c) for c in color[::-1]], -1)
+
+    images = cloud.view_from_many([camera, camera], workers=2)
+    assert np.array_equal(images[0], expected)
+    assert np.array_equal(images[0], images[1])
+    assert np.count_nonzero(images[0].any(axis=2)) > 0.02 * camera.width * camera.height
+
+def test_voxel_pyramid_levels_and_cache(tmp_path):
+    from glue.lod_util import VoxelPyramid
+
+    cloud = random_cloud(50000)
+    cloud.source = str(tmp_path / 'points.npy')
+    pyramid = cloud.pyramid
+    assert (tmp_path / 'points.lod.npz').exists()
+    assert len(VoxelPyramid.load(cloud.pyramidfile)) == len(pyramid) > 1
+
+    for size, xyz, count in zip(pyramid.sizes, pyramid.xyz, pyramid.count):
+        assert count.sum() == cloud.num_points
+        # voxel means average back to the mean of the whole cloud
+        assert np.allclose(np.average(xyz, axis=0, weights=count), cloud.xyz.mean(axis=0), atol=1e-3)
+        assert len(np.unique(np.floor((xyz - cloud.xyz.min(axis=0)) / size), axis=0)) == len(xyz)
+    assert all(b == 2 * a for a, b in zip(pyramid.sizes, pyramid.sizes[1:]))
+
+    preview = cloud.lod(budget=20000)
+    assert preview.num_points <= 20000 and preview is cloud.lod(budget=20000)
+    # the coarsest level is the floor for tighter budgets
+    assert cloud.lod(budget=10).num_points == len(pyramid.xyz[-1])
+    assert cloud.lod(budget=cloud.num_points) is cloud
+    assert cloud.lod(resolution=pyramid.sizes[1]).num_points == len(pyramid.xyz[1])
+
+    # an approximate ray cast on a fraction of the points
+    camera = nadir_camera(np.array([5.0, -3.0, 60.0]))
+    coarse = cloud.lod(budget=cloud.num_points // 10).ray_cast_many(camera, [[500, 400]], _pixel_buffer=30)
+    assert np.allclose(coarse[0, :2], [5.0, -3.0], atol=2.0)
+
+def test_voxel_pyramid_builds_level_zero_in_chunks():
+    from glue.lod_util import VoxelPyramid
+
+    cloud = random_cloud(50000)
+    whole = VoxelPyramid.build(cloud.xyz, cloud.rgb, chunk_size=cloud.num_points)
+    chunked = VoxelPyramid.build(cloud.xyz, cloud.rgb, chunk_size=997)
+    assert whole.sizes == chunked.sizes
+    for level in range(len(whole)):
+        assert np.array_equal(whole.count[level], chunked.count[level])
+        assert np.allclose(whole.xyz[level], chunked.xyz[level], atol=1e-4)
+        assert np.abs(whole.rgb[level].astype(int) - chunked.rgb[level]).max() <= 1
+
+def test_tiles_load_only_the_region_of_interest(tmp_path):
+    from glue.tile_util import TileSet
+
+    cloud = random_cloud(50000)
+    cloud.source = str(tmp_path / 'points.npy')
+    tiles = TileSet.write(cloud.xyz, cloud.rgb, cloud.tilefolder, tile_size=20.0, chunk_size=7000)
+    assert tiles.shape == (6, 6) and tiles.num_points == cloud.num_points
+    assert not os.path.exists(f'{cloud.tilefolder}.part')
+
+    # every point lands in exactly one tile, whole tiles round trip
+    xyz, rgb = TileSet.load(cloud.tilefolder).read(tiles.tiles)
+    order = np.lexsort(xyz.T)
+    expected = np.lexsort(cloud.xyz.T)
+    assert np.array_equal(xyz[order], cloud.xyz[expected])
+    assert np.array_equal(rgb[order], cloud.rgb[expected])
+
+    region = cloud.region(bbox=(-10, -10, 10, 10))
+    assert region.num_points < cloud.num_points / 4
+    assert len(region.query_bbox(-10, -10, 10, 10)) == len(cloud.query_bbox(-10, -10, 10, 10))
+
+    camera = nadir_camera(np.array([-40.0, -40.0, 20.0]))
+    region = cloud.region(camera=camera)
+    assert region.num_points < cloud.num_points
+    assert len(region.project_visible(camera)[1]) == len(cloud.project_visible(camera)[1])
+
+def test_las2numpy_writes_tiles(tmp_path):
+    from glue.tile_util import TileSet
+
+    las = str(tmp_path / 'points.las')
+    write_las(las, llapoints[:, :3], llapoints[:, 3:])
+    cloud = PointCloud(las, FakeTransform(), tile_size=5.0)
+    assert TileSet.load(cloud.tilefolder).num_points == 10
+
+def test_metadata_sidecar_opens_lazily_and_tracks_the_transform(tmp_path):
+    import json
+
+    las = str(tmp_path / 'points.las')
+    write_las(las, llapoints[:, :3], llapoints[:, 3:])
+    cloud = PointCloud(las, FakeTransform())
+    meta = json.load(open(tmp_path / 'points.meta.json'))
+    assert meta['count'] == 10 and meta['dtype'] == {'xyz': 'float32', 'rgb': 'uint8'}
+    assert meta['source']['path'] == 'points.las' and len(meta['source']['sha256']) == 64
+    assert np.allclose(meta['bounds'], [*enupoints[:, :2].min(axis=0), *enupoints[:, :2].max(axis=0)], atol=1e-3)
+
+    # reopening reads the sidecar only, the arrays are mapped on first access
+    cloud = PointCloud(las, FakeTransform())
+    assert cloud._xyz is None
+    assert cloud.num_points == 10 and np.allclose(cloud.bounds, meta['bounds'])
+    assert cloud._xyz is None
+    cloud.index
+    assert os.path.exists(cloud.indexfile)
+
+    # a different transform rebuilds the cache and everything derived from it
+    class Shifted(FakeTransform):
+        T = FakeTransform.T + [0.0, 0.0, 10.0]
+    shifted = PointCloud(las, Shifted())
+    assert not os.path.exists(cloud.indexfile)
+    assert not np.allclose(shifted.xyz, cloud.xyz, atol=1)
+    assert json.load(open(tmp_path / 'points.meta.json'))['transform'] != meta['transform']
+
+    # so does a new LAS under the same name
+    write_las(las, llapoints[:5, :3], llapoints[:5, 3:])
+    assert PointCloud(las, Shifted()).num_points == 5
+
+def test_caches_without_a_sidecar_are_adopted(tmp_path):
+
+    las = str(tmp_path / 'points.las')
+    write_las(las, llapoints[:, :3], llapoints[:, 3:])
+    PointCloud(las, FakeTransform())
+    os.remove(tmp_path / 'points.meta.json')
+    os.remove(las)
+
+    cloud = PointCloud(las, FakeTransform())
+    assert cloud.num_points == 10 and cloud.meta['source'] is None
+    assert os.path.exists(tmp_path / 'points.meta.json')
+
+def test_tiles_are_written_with_few_open_files(tmp_path):
+    import resource
+    from glue.tile_util import TileSet
+
+    rng = np.random.default_rng(3)
+    cloud = PointCloud.from_arrays(rng.uniform([0, 0, 0], [130, 130, 5], size=(30000, 3)))
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(256, hard), hard))
+    try:
+        tiles = TileSet.write(cloud.xyz, cloud.rgb, str(tmp_path / 'points.tiles'), tile_size=5.0, chunk_size=4000)
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+    assert len(tiles.tiles) > 512
+    xyz, _ = tiles.read(tiles.tiles)
+    assert np.array_equal(xyz[np.lexsort(xyz.T)], cloud.xyz[np.lexsort(cloud.xyz.T)])
+
+def test_is_cached_needs_the_compact_cache_and_a_matching_sidecar(tmp_path):
+
+    las = str(tmp_path / 'points.las')
+    assert not PointCloud.is_cached(las, FakeTransform())
+    write_las(las, llapoints[:, :3], llapoints[:, 3:])
+    PointCloud(las, FakeTransform())
+    os.remove(las)
+    assert PointCloud.is_cached(las, FakeTransform())
+
+    class Shifted(FakeTransform):
+        T = FakeTransform.T + [0.0, 0.0, 10.0]
+    assert not PointCloud.is_cached(las, Shifted())
+    os.remove(tmp_path / 'points.rgb.npy')
+    assert not PointCloud.is_cached(las, FakeTransform())
+
+def test_lazy_structures_are_built_once_across_threads(tmp_path, mocker):
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from glue.spatial_util import GridIndex
+
+    build = GridIndex.build
+    def slow_build(xyz):
+        time.sleep(0.05)
+        return build(xyz)
+    builds = mocker.patch('glue.pointcloud_utils.GridIndex.build', side_effect=slow_build)
+
+    cloud = random_cloud(1000)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        indexes = list(pool.map(lambda _: cloud.index, range(8)))
+    assert builds.call_count == 1 and all(index is indexes[0] for index in indexes)
+
+    # concurrent saves of one cache file write through separate .part files
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(lambda _: indexes[0].save(str(tmp_path / 'points.index.npz')), range(8)))
+    assert os.listdir(tmp_path) == ['points.index.npz']
+    assert GridIndex.load(str(tmp_path / 'points.index.npz')).num_points == 1000
+
+def test_assigning_points_detaches_the_cloud_from_its_cache(tmp_path):
+    from glue.spatial_util import GridIndex
+
+    las = str(tmp_path / 'points.las')
+    write_las(las, llapoints[:, :3], llapoints[:, 3:])
+    cloud = PointCloud(las, FakeTransform())
+    cloud.index
+    cloud.xyz = cloud.xyz[:4]
+    assert cloud.source is None and cloud.meta is None and cloud._index is None
+    assert cloud.num_points == 4 and cloud.index.num_points == 4
+    # the colours stay those of the cache they were mapped from
+    assert len(cloud.rgb) == 10
+    # and the cached index of the full cloud is left alone
+    assert GridIndex.load(str(tmp_path / 'points.index.npz')).num_points == 10
+
+    cloud = PointCloud(las, FakeTransform())
+    cloud.rgb = np.zeros((10, 3), dtype=np.uint8)
+    assert cloud.source is None and cloud.meta is None and len(cloud.xyz) == 10
+
+def test_derived_files_report_to_the_cache_manager(tmp_path):
+    from glue.cache_util import CacheManager
+
+    cache = CacheManager(str(tmp_path))
+    las = str(tmp_path / 'points.las')
+    write_las(las, llapoints[:, :3], llapoints[:, 3:])
+    PointCloud(las, FakeTransform(), cache=cache).index
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    indexfile = tmp_path / 'points.index.npz'
+    os.utime(indexfile, (1000, os.path.getmtime(indexfile)))
+    PointCloud(las, FakeTransform(), cache=cache).index
+    assert (cache.hits, cache.misses) == (1, 1)
+    # reads move the LRU order even where the filesystem does not update atime
+    assert os.path.getatime(indexfile) > 1000
@@ -0,0 +1,181 @@
+import sys
+import os
+cwd = os.getcwd()
+sys.path.append(cwd)
+
+import json
+import pytest
+# glue.scene pulls in the mesh module, which needs open3d
+pytest.importorskip('open3d')
+from glue.scene import Scene
+from glue.plan_util import Api
+from tests.conftest import FakeResponse
+
+def cached_scene(tmp_path, response):
+    scene = Scene.__new__(Scene)
+    scene.plan_id = 'plan'
+    scene.base_cache_folder = str(tmp_path)
+    scene._manifest = None
+    scene.api = Api('plan', {})
+    scene.api.request = lambda endpoint, headers=None: response
+    os.makedirs(scene.cache_folder)
+    (scene.cache_folder / 'plan.json').write_text('{"id": "plan"}')
+    scene.manifest.record('plan.json')
+    return scene
+
+def test_fetch_json_keeps_cached_copy_on_server_error(tmp_path):
+
+    for body in ({'code': 503, 'message': 'unavailable'}, b'<html>bad gateway</html>'):
+        scene = cached_scene(tmp_path / str(len(body)), FakeResponse(body, status_code=503))
+        assert scene.fetch_json('plan.json', 'plan', ttl=0) == {'id': 'plan'}
+        assert json.load(open(scene.cache_folder / 'plan.json')) == {'id': 'plan'}
+
+    scene = cached_scene(tmp_path / 'ok', FakeResponse({'id': 'plan', 'name': 'new'}))
+    assert scene.fetch_json('plan.json', 'plan', ttl=0)['name'] == 'new'
+
+def test_evicted_exports_are_not_downloaded_again(tmp_path, mocker):
+    import zipfile
+    from glue.cache_util import CacheManager
+    from tests.test_pointcloud_utils import FakeTransform, write_las
+    from tests.test_conv_utils import llapoints
+
+    scene = cached_scene(tmp_path, None)
+    scene.cache = CacheManager(str(tmp_path))
+    scene.transform = FakeTransform()
+    scene.plan = {'exports': [{'url': 'https://exports/points.zip'}]}
+    las = scene.cache_folder / 'points.las'
+    write_las(str(las), llapoints[:, :3], llapoints[:, 3:])
+    with zipfile.ZipFile(scene.cache_folder / 'points.zip', 'w') as archive:
+        archive.write(las, 'points.las')
+    os.remove(las)
+
+    download = mocker.patch.object(Scene, 'download_signed_url', side_effect=AssertionError('downloaded again'))
+    scene.download_pointcloud()
+    assert scene._pointcloud.num_points == 10
+
+    # neither the zip nor the LAS is needed once the compact cache exists
+    os.remove(scene.cache_folder / 'points.zip')
+    scene.download_export(scene.plan, 'points.zip')
+    os.remove(las)
+    scene.download_pointcloud()
+    assert scene._pointcloud.num_points == 10
+    assert not download.called
+
+def test_scenes_release_the_plan_on_close_or_collection(tmp_path):
+    import gc
+    from glue.cache_util import CacheManager
+
+    def opened_scene():
+        scene = Scene.__new__(Scene)
+        scene.plan_id, scene.base_cache_folder = 'plan', str(tmp_path)
+        scene.cache = CacheManager(str(tmp_path))
+        scene.create_cache()
+        return scene
+
+    with opened_scene() as scene:
+        other = opened_scene()
+        assert scene.cache.is_open('plan')
+    assert other.cache.is_open('plan')
+    scene.close()
+    assert other.cache.is_open('plan')
+
+    # nothing but the scene itself keeps the plan open
+    del other
+    gc.collect()
+    assert not scene.cache.is_open('plan')
+
+def fake_plan_server(mocker, images=('a.jpg', 'b.jpg')):
+    # answers the plan, camfile, image and export urls of a one-sensor plan
+    import io, time, zipfile
+    import numpy as np
+    from tests.test_pointcloud_utils import FakeTransform, write_las
+    from tests.test_conv_utils import llapoints
+
+    las = io.BytesIO()
+    write_las(las, llapoints[:, :3], llapoints[:, 3:])
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zf:
+        zf.writestr('points.las', las.getvalue())
+    exports = {'points.zip': archive.getvalue(), 'model.zip': b''}
+
+    plan = {'id': 'plan', 'folder_id': 'folder', 'geometry': [],
+            'exports': [{'url': f'https://exports/{name}?signature=1'} for name in exports]}
+    cameras = {
+        'sensors': [{'resolution': {'width': 100, 'height': 80}, 'calibration': {'fx': 100, 'fy': 100, 'cx': 50, 'cy': 40}}],
+        'cameras': [{'transform': ' '.join(map(str, np.eye(4).ravel())), 'image': image, 'enabled': True} for image in images],
+        'transform': {
+            'translation': ' '.join(map(str, FakeTransform.T)),
+            'rotation': ' '.join(map(str, FakeTransform.Rinv.T.ravel())),
+            'scale': '1.0',
+        },
+    }
+
+    requested = []
+    def get(url, headers=None, stream=False):
+        requested.append(url.split('?')[0])
+        if url.endswith(f'/plan/plan'):
+            return FakeResponse(plan)
+        if url.endswith(f'/camfile/plan'):
+            return FakeResponse(cameras)
+        if url.startswith('https://exports/'):
+            time.sleep(0.05)
+            body = exports[url.split('/')[-1].split('?')[0]]
+            return FakeResponse(body, headers={'Content-Length': str(len(body))})
+        return FakeResponse(b'jpeg', headers={'Content-Length': '4'})
+
+    mocker.patch('glue.http_util.client.get', side_effect=get)
+    return requested
+
+def test_lazy_scene_fetches_assets_on_first_use(tmp_path, mocker, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    monkeypatch.setenv('DRONEDEPLOY', 'token')
+    requested = fake_plan_server(mocker)
+    scene = Scene('plan', str(tmp_path), lazy=True)
+    assert [url.split('/')[-2] for url in requested] == ['plan', 'camfile']
+
+    del requested[:]
+    assert os.path.exists(scene.cameras[1].filename)
+    assert len(requested) == 1 and '/images/b.jpg/' in requested[0]
+
+    # concurrent first access downloads and converts the cloud once
+    del requested[:]
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        clouds = list(pool.map(lambda _: scene.pointcloud, range(4)))
+    assert requested == ['https://exports/points.zip']
+    assert all(cloud is clouds[0] for cloud in clouds) and clouds[0].num_points == 10
+
+    del requested[:]
+    scene.prefetch(mesh=False)
+    assert len(requested) == 1 and '/images/a.jpg/' in requested[0]
+    assert scene._mesh is None
+    scene.close()
+
+def test_reprocessed_plan_drops_its_stale_exports(tmp_path, mocker):
+    from tests.test_pointcloud_utils import FakeTransform, write_las
+    from tests.test_conv_utils import llapoints
+    from glue.pointcloud_utils import PointCloud
+    from glue.config import config
+
+    plan = lambda version, signature: {'id': 'plan', 'exports': [
+        {'url': f'https://exports/{version}/points.zip?signature={signature}'},
+        {'url': f'https://exports/v1/model.zip?signature={signature}'},
+    ]}
+    scene = cached_scene(tmp_path, FakeResponse(plan('v2', 'b')))
+    (scene.cache_folder / 'plan.json').write_text(json.dumps(plan('v1', 'a')))
+    scene.manifest.record('plan.json')
+
+    las = scene.cache_folder / 'points.las'
+    write_las(str(las), llapoints[:, :3], llapoints[:, 3:])
+    PointCloud(las, FakeTransform())
+    for name, members in (('points.zip', {'points.las': las.stat().st_size}), ('model.zip', {})):
+        (scene.cache_folder / name).write_bytes(b'zip')
+        (scene.cache_folder / f'{name}.members.json').write_text(json.dumps(members))
+
+    mocker.patch.object(config, 'PLAN_TTL', 0)
+    scene.download_plan()
+    assert scene.plan == plan('v2', 'b')
+    assert not PointCloud.is_cached(las, FakeTransform())
+    remaining = sorted(os.listdir(scene.cache_folder))
+    assert 'points.zip' not in remaining and 'points.las' not in remaining and 'points.xyz.npy' not in remaining
+    assert 'model.zip' in remaining and 'model.zip.members.json' in remaining
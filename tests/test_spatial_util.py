@@ -0,0 +1,71 @@
+import sys
+import os
+cwd = os.getcwd()
+sys.path.append(cwd)
+
+import numpy as np
+from glue.spatial_util import GridIndex, points_in_polygon, points_in_rings, polygon_rings
+
+rng = np.random.default_rng(0)
+xyz = rng.uniform([-50, -20, 0], [50, 80, 10], size=(5000, 3)).astype(np.float32)
+
+def test_points_in_polygon():
+    px = np.array([0.5, 1.5, 0.5, 0.9])
+    py = np.array([0.5, 0.5, 1.5, 0.2])
+    # unit square with a notch cut out of its top right
+    vx = np.array([0, 1, 1, 0.5, 0])
+    vy = np.array([0, 0, 0.5, 1, 1])
+    assert points_in_polygon(px, py, vx, vy).tolist() == [True, False, False, True]
+
+def box(x0, y0, x1, y1):
+    return np.array([x0, x1, x1, x0]), np.array([y0, y0, y1, y1])
+
+def in_box(x0, y0, x1, y1):
+    return (xyz[:, 0] > x0) & (xyz[:, 0] < x1) & (xyz[:, 1] > y0) & (xyz[:, 1] < y1)
+
+def test_points_in_rings_with_holes_and_parts():
+    # a square with a square hole, and a second disjoint square
+    polygon = [[box(-40, 0, 0, 40), box(-30, 10, -10, 30)], [box(10, 50, 30, 70)]]
+    rings = polygon_rings(polygon)
+    assert len(rings) == 3
+
+    expected = (in_box(-40, 0, 0, 40) & ~in_box(-30, 10, -10, 30)) | in_box(10, 50, 30, 70)
+    assert np.array_equal(points_in_rings(xyz[:, 0], xyz[:, 1], rings), expected)
+    assert polygon_rings(box(0, 0, 1, 1))[0][0].tolist() == [0, 1, 1, 0]
+
+def test_label_polygons():
+
+    index = GridIndex.build(xyz)
+    areas = [box(-40, 0, 0, 40), [box(-20, 20, 20, 60), box(-5, 25, 5, 35)], box(100, 100, 110, 110)]
+    labels = index.label_polygons(xyz, areas)
+
+    expected = np.full(len(xyz), -1)
+    second = in_box(-20, 20, 20, 60) & ~in_box(-5, 25, 5, 35)
+    expected[second] = 1
+    # the first area wins where two overlap
+    expected[in_box(-40, 0, 0, 40)] = 0
+    assert np.array_equal(labels, expected)
+
+def test_grid_index_queries_match_brute_force(tmp_path):
+
+    index = GridIndex.build(xyz)
+    index.save(str(tmp_path / 'points.index.npz'))
+    index = GridIndex.load(str(tmp_path / 'points.index.npz'))
+
+    inside = (xyz[:, 0] > -10) & (xyz[:, 0] < 5) & (xyz[:, 1] > 30) & (xyz[:, 1] < 33)
+    assert np.array_equal(np.sort(index.query_bbox(xyz, -10, 30, 5, 33)), np.where(inside)[0])
+
+    center = np.array([3.0, 4.0, 5.0])
+    distance = np.linalg.norm(xyz - center, axis=1)
+    assert np.array_equal(np.sort(index.query_radius(xyz, center, 7.5)), np.where(distance <= 7.5)[0])
+    assert np.array_equal(index.query_knn(xyz, center, 10), np.argsort(distance)[:10])
+
+    # a centre far outside the cloud still finds its neighbours
+    far = np.array([500.0, 500.0])
+    distance = np.linalg.norm(xyz[:, :2] - far, axis=1)
+    assert np.array_equal(index.query_knn(xyz, far, 3), np.argsort(distance)[:3])
+
+    vx = np.array([-30, 20, 0])
+    vy = np.array([0, 10, 60])
+    expected = np.where(points_in_polygon(xyz[:, 0], xyz[:, 1], vx, vy))[0]
+    assert np.array_equal(np.sort(index.query_polygon(xyz, vx, vy)), expected)